@@ -1,3 +1,4 @@
+import argparse
 import openpyxl
 from openpyxl.worksheet.datavalidation import DataValidation
 from openpyxl.styles import PatternFill, Font, Alignment
@@ -6,14 +7,19 @@ import aiohttp
 import asyncio
 import pandas as pd
 from datetime import datetime
-from requests.auth import HTTPBasicAuth
 import logging
-from aiohttp import BasicAuth, ClientSession, ClientTimeout
+from aiohttp import ClientSession, ClientTimeout
 from tqdm.asyncio import tqdm
 import os
 import zipfile
 import getpass
+import math
 from typing import Any, Dict, Optional, List
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # moysklad_common/
+from moysklad_common.auth import TokenAuth
+from moysklad_common.cassette import Cassette
+from moysklad_common.ratelimit import RateLimitGovernor
 
 # Configure logging to log only to a file
 logging.basicConfig(
@@ -123,76 +129,126 @@ def compare_and_highlight_changes(wb: openpyxl.Workbook, current_sheet: str, pre
             for cell in previous_data[key]:
                 cell.fill = disappeared_row_fill
 
-# Prompt user for authentication details
-USERNAME = input("Enter your username: ")
-PASSWORD = getpass.getpass("Enter your password: ")
-auth = BasicAuth(USERNAME, PASSWORD)
+# Set in main() once the user has entered their credentials; replayed runs go without
+auth: Optional[TokenAuth] = None
 base_url = "https://api.moysklad.ru/api/remap/1.2/report/stock/all"
+assortment_url = "https://api.moysklad.ru/api/remap/1.2/entity/assortment"
+MAX_URL_LENGTH = 8000  # id-filtered request URLs stay under the usual 8 KB request-line limit of web servers
 included_price_types = ["Цена розница", "Цена маркетплейс", "Цена мелкий опт", "Цена средний опт"]
 
-# Define a global semaphore to limit concurrent HTTP requests
-semaphore = asyncio.Semaphore(5)
+# Shared governor that paces all HTTP requests by MoySklad's rate-limit headers
+governor = RateLimitGovernor(max_concurrency=5)
 
 async def fetch(session: ClientSession, url: str, retries: int = 5) -> Optional[Dict[str, Any]]:
     """
-    Fetches JSON data from a URL using the provided session. Retries on failure with specific handling for 429 errors.
+    Fetches JSON data from a URL using the provided session. Requests are paced by the shared
+    governor; 429 responses are retried once the governor's pause has passed, and a 401
+    refreshes the access token once.
     """
-    async with semaphore:
-        for attempt in range(retries):
-            try:
-                async with session.get(url, auth=auth) as response:
+    token_refreshed = False
+    for attempt in range(retries):
+        try:
+            async with governor:
+                headers = await auth.headers(session) if auth else None
+                token = auth.token if auth else None
+                async with session.get(url, headers=headers) as response:
+                    governor.update(response.status, response.headers)
+                    if response.status == 429:  # Too Many Requests
+                        logging.warning(f"Attempt {attempt + 1} for {url} throttled (429)")
+                        continue
+                    if response.status == 401 and auth is not None and not token_refreshed:
+                        token_refreshed = True
+                        if await auth.refresh(session, token):
+                            logging.info(f"Access token refreshed, retrying {url}")
+                            continue
                     response.raise_for_status()
                     return await response.json()
-            except aiohttp.ClientResponseError as e:
-                if e.status == 429:  # Too Many Requests
-                    logging.warning(f"Attempt {attempt + 1} for {url} failed with 429: {e}")
-                    if attempt < retries - 1:
-                        retry_after = int(e.headers.get('Retry-After', 1))
-                        logging.info(f"Retrying after {retry_after} seconds...")
-                        await asyncio.sleep(retry_after)
-                    else:
-                        logging.error(f"All {retries} attempts failed for URL: {url}")
-                        return None
-                else:
-                    logging.error(f"Request failed for {url}: {e}")
-                    return None
-            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                logging.warning(f"Attempt {attempt + 1} for {url} failed: {e}")
-                if attempt < retries - 1:
-                    await asyncio.sleep(1)  # Fixed delay between retries
-                else:
-                    logging.error(f"All {retries} attempts failed for URL: {url}")
-                    return None
-        return None
+        except aiohttp.ClientResponseError as e:
+            logging.error(f"Request failed for {url}: {e}")
+            return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning(f"Attempt {attempt + 1} for {url} failed: {e}")
+            if attempt < retries - 1:
+                await asyncio.sleep(1)  # Fixed delay between retries
+            else:
+                logging.error(f"All {retries} attempts failed for URL: {url}")
+                return None
+    logging.error(f"All {retries} attempts failed for URL: {url}")
+    return None
 
-async def fetch_product_details(session: ClientSession, product: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+def entity_id(href: str) -> str:
     """
-    Fetches detailed information for a product and returns a structured dictionary with relevant data.
+    Extracts the entity id from a meta href (drops any ?expand=... query).
     """
-    meta_url: Optional[str] = product.get('meta', {}).get('href')
-    if not meta_url:
-        logging.warning(f"No meta URL found for product: {product.get('name')}")
-        return None
+    return href.split('?', 1)[0].rstrip('/').rsplit('/', 1)[-1]
+
+def id_filter_urls(ids: List[str]) -> List[str]:
+    """
+    Builds id-filtered assortment URLs for the given ids, packing as many ids into each
+    URL as MAX_URL_LENGTH allows.
+    """
+    prefix = f"{assortment_url}?limit=1000&filter="
+    urls = []
+    chunk: List[str] = []
+    length = len(prefix)
+    for i in ids:
+        term = f"id={i}"
+        if chunk and length + len(term) + 1 > MAX_URL_LENGTH:
+            urls.append(prefix + ";".join(chunk))
+            chunk, length = [], len(prefix)
+        chunk.append(term)
+        length += len(term) + 1
+    if chunk:
+        urls.append(prefix + ";".join(chunk))
+    return urls
+
+async def fetch_assortment_records(session: ClientSession, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Fetches the assortment records (products and variants) for the given ids in bulk.
+    Uses id-filtered requests or a full paginated scan of the assortment, whichever
+    needs fewer requests, and returns the records keyed by id.
+    """
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return {}
+
+    urls = id_filter_urls(ids)
+    probe = await fetch(session, f"{assortment_url}?limit=1")
+    total = probe.get('meta', {}).get('size') if probe else None
+    scan_requests = math.ceil(total / 1000) if total is not None else math.inf
+
+    # Either way the requests go out together, paced by the governor
+    if scan_requests < len(urls):
+        logging.info(f"Enriching {len(ids)} rows with a full assortment scan ({scan_requests} requests)")
+        rows = await fetch_all_products(session, assortment_url, total=total)
+    else:
+        logging.info(f"Enriching {len(ids)} rows with id-filtered requests ({len(urls)} requests)")
+        pages = await asyncio.gather(*[fetch(session, url) for url in urls])
+        rows = [row for page in pages if page for row in page.get('rows', [])]
+
+    wanted = set(ids)
+    return {row['id']: row for row in rows if row.get('id') in wanted}
 
-    await asyncio.sleep(0.005)  # Small delay between requests
-    logging.info(f"Fetching details for product: {product.get('name')}")
-    metaid = await fetch(session, meta_url)
-    if metaid is None:
-        logging.warning(f"Failed to fetch details for product: {product.get('name')}")
+def product_details(product: Dict[str, Any], record: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Joins a stock report row with its assortment record and returns a structured dictionary with relevant data.
+    """
+    if record is None:
+        logging.warning(f"No assortment record found for product: {product.get('name')}")
         return None
 
     # Default category value
     category_value = "dNf"
     
     # Access characteristics
-    characteristics: List[Dict[str, Any]] = metaid.get('characteristics', [])
+    characteristics: List[Dict[str, Any]] = record.get('characteristics', [])
     for char in characteristics:
         if char.get('name') == "Категория":
             category_value = char.get('value')
             break  # Stop once category is found
 
     # Get all sale prices and filter based on included price types
-    sale_prices = metaid.get('salePrices', [])
+    sale_prices = record.get('salePrices', [])
     prices = {
         price.get('priceType', {}).get('name', 'Unknown'): price.get('value', 0) / 100
         for price in sale_prices
@@ -209,31 +265,50 @@ async def fetch_product_details(session: ClientSession, product: Dict[str, Any])
         'prices': prices
     }
 
-async def fetch_all_products(session: ClientSession, base_url: str, limit: int = 1000) -> List[Dict[str, Any]]:
+async def fetch_all_products(session: ClientSession, base_url: str, limit: int = 1000,
+                             total: Optional[int] = None) -> List[Dict[str, Any]]:
     """
-    Fetches all products using pagination.
+    Fetches all products using pagination. Once the number of rows is known (`total`, or
+    meta.size of the first page) the remaining pages are requested concurrently; the
+    governor keeps them within MoySklad's limits. Rows are returned in offset order.
     """
     offset = 0
     all_products = []
-    while True:
-        url = f"{base_url}?limit={limit}&offset={offset}"
-        response = await fetch(session, url)
+    if total is None:
+        response = await fetch(session, f"{base_url}?limit={limit}&offset=0")
         if response is None:
             logging.error("Failed to fetch products or received empty response.")
-            break
-        products = response.get('rows', [])
-        if not products:
-            break
-        all_products.extend(products)
-        offset += limit
+            return all_products
+        all_products.extend(response.get('rows', []))
+        total = response.get('meta', {}).get('size', 0)
+        offset = limit
+
+    offsets = range(offset, total, limit)
+    pages = await asyncio.gather(*[fetch(session, f"{base_url}?limit={limit}&offset={o}") for o in offsets])
+    for page_offset, response in zip(offsets, pages):
+        if response is None:
+            logging.error(f"Failed to fetch products at offset {page_offset}.")
+            continue
+        all_products.extend(response.get('rows', []))
     return all_products
 
-async def main() -> None:
+async def main(cassette: Optional[Cassette] = None) -> None:
+    global auth
+    if cassette is None or not cassette.replay:
+        # Prompt user for authentication details
+        username = input("Enter your username: ")
+        password = getpass.getpass("Enter your password: ")
+        auth = TokenAuth(username, password)
+
     filename = "products.xlsx"
     # Set a timeout for the entire session to avoid hanging requests
     timeout = ClientTimeout(total=30)
+    session = ClientSession(timeout=timeout)
+    if cassette is not None:
+        # --record saves all traffic of the run, --replay serves it back offline
+        session = cassette.wrap(session)
 
-    async with ClientSession(timeout=timeout) as session:
+    async with session:
         logging.info("Fetching all products...")
         products = await fetch_all_products(session, base_url)
         if not products:
@@ -241,22 +316,17 @@ async def main() -> None:
             return
         logging.info(f"Fetched {len(products)} products.")
 
-        async def limited_fetch_product_details(product: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-            async with semaphore:
-                return await fetch_product_details(session, product)
-
-        tasks = [limited_fetch_product_details(product) for product in products]
-
-        # Use tqdm to display progress as tasks complete
-        results = []
+        # Fetch characteristics and prices for all rows in bulk, then join locally
         logging.info("Fetching product details...")
-        for result in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc=color.YELLOW + "Загружаю данные" + color.END):
-            try:
-                details = await result
-                results.append(details)
-                logging.info(f"Fetched details for product: {details['name'] if details else 'Unknown'}")
-            except Exception as e:
-                logging.error(f"Error fetching product details: {e}")
+        ids = [entity_id(p['meta']['href']) for p in products if p.get('meta', {}).get('href')]
+        records = await fetch_assortment_records(session, ids)
+        results = []
+        for product in tqdm(products, desc=color.YELLOW + "Загружаю данные" + color.END):
+            href = product.get('meta', {}).get('href')
+            if not href:
+                logging.warning(f"No meta URL found for product: {product.get('name')}")
+                continue
+            results.append(product_details(product, records.get(entity_id(href))))
 
         logging.info("Fetched product details.")
 
@@ -321,7 +391,10 @@ async def main() -> None:
 
 # Run the main function with proper exception handling.
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the MoySklad stock report to Excel.")
+    Cassette.add_arguments(parser)
+    args = parser.parse_args()
     try:
-        asyncio.run(main())
+        asyncio.run(main(Cassette.from_args(args)))
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
@@ -1,9 +1,10 @@
 # -*- mode: python ; coding: utf-8 -*-
+import os
 
 
 a = Analysis(
     ['4final.py'],
-    pathex=[],
+    pathex=[os.path.dirname(os.path.dirname(SPECPATH))],  # moysklad_common/
     binaries=[],
     datas=[],
     hiddenimports=[],
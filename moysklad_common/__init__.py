@@ -0,0 +1,7 @@
+"""
+Modules shared by the scripts in this repository (somethingnew/,
+fromthebigginig/, tz1/, ver1/). The scripts are run from their own
+directories, so each one puts the repository root on sys.path before
+importing from here; PyInstaller builds get it through `pathex` in the
+.spec file.
+"""
@@ -0,0 +1,214 @@
+"""
+Bearer-token auth for the MoySklad API, shared by all scripts: TokenAuth
+for the aiohttp scripts, BearerTokenAuth for the requests-based ones.
+
+The token is requested at POST /security/token with the user's
+credentials, cached in TOKEN_FILE (readable by the current user only) and
+reused by later runs, so credentials are not sent with every request.
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+import aiohttp
+import requests
+from aiohttp import BasicAuth, ClientSession
+from requests.auth import HTTPBasicAuth
+
+TOKEN_URL = "https://api.moysklad.ru/api/remap/1.2/security/token"
+TOKEN_FILE = os.path.join(os.path.expanduser("~"), ".moysklad_tokens.json")
+MAX_LOGIN_ATTEMPTS = 3  # New credentials asked for after the current ones are rejected
+
+RED = '\033[91m'
+END = '\033[0m'
+
+
+class TokenCache:
+    """Tokens by login in `path`, readable by the current user only."""
+
+    def __init__(self, path: str = TOKEN_FILE):
+        self.path = path
+
+    def _load(self) -> Dict[str, str]:
+        try:
+            with open(self.path, 'r') as f:
+                tokens = json.load(f)
+            return tokens if isinstance(tokens, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, login: str) -> Optional[str]:
+        return self._load().get(login)
+
+    def save(self, login: str, token: str) -> None:
+        tokens = self._load()
+        tokens[login] = token
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(tokens, f)
+        os.chmod(self.path, 0o600)  # O_CREAT's mode does not apply to an existing file
+
+
+class TokenAuth:
+    """
+    Bearer-token auth, also the auth gate for all requests: a 401 closes
+    the gate so nothing new is dispatched, the token is replaced once and
+    every waiting request resumes with the result.
+
+    A cached token of `login` is used as is, so without a `password` a run
+    needs no password until the token has to be replaced. Then, or when
+    the password is rejected, `credential_source` is asked for credentials
+    on a worker thread (up to `max_attempts` times): with the login on the
+    first call without a password, with None after a rejection, when the
+    login may have been mistyped too. Once that fails - or
+    right away without a `credential_source` - the auth is `failed`: no
+    more token requests are sent and requests go out without a token.
+    """
+
+    def __init__(
+        self,
+        login: str,
+        password: Optional[str] = None,
+        credential_source: Optional[Callable[[Optional[str]], Tuple[str, str]]] = None,
+        token_url: str = TOKEN_URL,
+        token_file: str = TOKEN_FILE,
+        max_attempts: int = MAX_LOGIN_ATTEMPTS
+    ):
+        self.login = login
+        self.password = password
+        self.credential_source = credential_source
+        self.token_url = token_url
+        self.tokens = TokenCache(token_file)
+        self.max_attempts = max_attempts
+        self.token: Optional[str] = self.tokens.get(login)
+        self.failed = False
+        self._lock = asyncio.Lock()
+        self._open = asyncio.Event()
+        self._open.set()
+
+    async def headers(self, session: ClientSession) -> Dict[str, str]:
+        await self._open.wait()
+        if self.token is None and not self.failed:
+            await self.refresh(session, None)
+        return {'Authorization': f'Bearer {self.token}'} if self.token else {}
+
+    async def refresh(self, session: ClientSession, stale_token: Optional[str]) -> bool:
+        """
+        Replace `stale_token` unless another request already has. Tries the
+        current credentials first, then up to `max_attempts` new ones.
+        """
+        async with self._lock:
+            if self.token is not None and self.token != stale_token:
+                return True
+            if self.failed:
+                return False
+            self._open.clear()
+            try:
+                if self.password is not None and await self._request_token(session):
+                    return True
+                if self.credential_source is None:
+                    self.failed = True
+                    return False
+                for _ in range(self.max_attempts):
+                    known_login = self.login if self.password is None else None
+                    if known_login is None:
+                        print(RED + "❌ Логин или пароль не подошли, введите их заново." + END)
+                    # Prompted off the event loop so in-flight requests keep being served
+                    self.login, self.password = await asyncio.to_thread(self.credential_source, known_login)
+                    if await self._request_token(session):
+                        return True
+                self.failed = True
+                return False
+            finally:
+                self._open.set()
+
+    async def _request_token(self, session: ClientSession) -> bool:
+        try:
+            async with session.post(self.token_url, auth=BasicAuth(self.login, self.password)) as response:
+                if response.status not in (200, 201):
+                    logging.error(f"Token request failed with status {response.status}")
+                    return False
+                data = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"Token request failed: {e}")
+            return False
+        self.token = data.get('access_token')
+        if not self.token:
+            return False
+        self.tokens.save(self.login, self.token)
+        logging.info("Obtained a new access token")
+        return True
+
+
+class BearerTokenAuth(requests.auth.AuthBase):
+    """
+    TokenAuth for requests sessions, safe to share between threads. The
+    first request without a cached token gets one; a 401 replaces it once
+    for all threads and the request is resent. A rejected password or a
+    failed token request makes the auth `failed`: no more token requests
+    are sent and requests go out without a token.
+    """
+
+    def __init__(self, login: str, password: Optional[str], token_url: str = TOKEN_URL,
+                 token_file: str = TOKEN_FILE):
+        self.login = login
+        self.password = password
+        self.token_url = token_url
+        self.tokens = TokenCache(token_file)
+        self.token: Optional[str] = self.tokens.get(login)
+        self.failed = False
+        self._lock = threading.Lock()
+
+    def refresh(self, stale_token: Optional[str]) -> bool:
+        """Get a new token, unless another thread already replaced `stale_token`."""
+        with self._lock:
+            if self.token is not None and self.token != stale_token:
+                return True
+            if self.failed or self.password is None:
+                self.failed = True
+                return False
+            try:
+                response = requests.post(self.token_url, auth=HTTPBasicAuth(self.login, self.password))
+                if response.status_code not in (200, 201):
+                    logging.error(f"Token request failed with status {response.status_code}")
+                    self.failed = True
+                    return False
+                token = response.json().get('access_token')
+            except (requests.RequestException, ValueError) as e:
+                logging.error(f"Token request failed: {e}")
+                self.failed = True
+                return False
+            if not token:
+                self.failed = True
+                return False
+            self.token = token
+            self.tokens.save(self.login, self.token)
+            logging.info("Obtained a new access token")
+            return True
+
+    def handle_401(self, response, **kwargs):
+        if response.status_code != 401 or getattr(response.request, 'token_retried', False):
+            return response
+        stale_token = response.request.headers.get('Authorization', '')[len('Bearer '):] or None
+        if not self.refresh(stale_token):
+            return response
+        response.content  # Drain the body so the connection can be reused
+        response.close()
+        retry = response.request.copy()
+        retry.headers['Authorization'] = f'Bearer {self.token}'
+        retry.token_retried = True
+        new_response = response.connection.send(retry, **kwargs)
+        new_response.history.append(response)
+        new_response.request = retry
+        return new_response
+
+    def __call__(self, request):
+        if self.token is None and not self.failed:
+            self.refresh(None)
+        if self.token:
+            request.headers['Authorization'] = f'Bearer {self.token}'
+        request.register_hook('response', self.handle_401)
+        return request
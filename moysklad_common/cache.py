@@ -0,0 +1,112 @@
+"""
+Disk-backed HTTP response cache with ETag/Last-Modified revalidation,
+shared by the scripts that fetch slowly changing entities (ver1, tz1).
+"""
+import sqlite3
+import time
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+CACHE_MAX_BYTES = 50 * 1024 * 1024  # Total size of stored bodies
+
+CacheEntry = namedtuple('CacheEntry', 'etag last_modified stored_at body')
+
+
+class ResponseCache:
+    """
+    Disk-backed (SQLite) cache of GET responses for slowly changing entities,
+    keyed by account and full URL. `ttls` maps entity names ("store",
+    "metadata", ...) to the seconds a response is served without
+    revalidation; other entities are not cached.
+
+    Within an entity's TTL a cached body is served without touching the
+    network; after that the request is revalidated with If-None-Match /
+    If-Modified-Since and a 304 just refreshes the entry. The total size of
+    stored bodies is bounded; least recently used entries are evicted first.
+    """
+
+    def __init__(self, path, ttls, max_bytes=CACHE_MAX_BYTES):
+        self.ttls = ttls
+        self.max_bytes = max_bytes
+        self.hits = 0         # served from disk, no request
+        self.revalidated = 0  # 304 Not Modified
+        self.misses = 0       # full download
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " account TEXT, url TEXT, etag TEXT, last_modified TEXT,"
+            " stored_at REAL, used_at REAL, size INTEGER, body BLOB,"
+            " PRIMARY KEY (account, url))"
+        )
+        self.conn.commit()
+
+    def ttl_for(self, url):
+        # Cacheable entity of a URL: metadata endpoints, or the last known
+        # entity name in the path (so entity/store/<id> is cached like entity/store)
+        parts = urlsplit(url).path.strip('/').split('/')
+        if 'metadata' in parts:
+            return self.ttls.get('metadata')
+        entity = next((part for part in reversed(parts) if part in self.ttls), None)
+        return self.ttls.get(entity)
+
+    def lookup(self, account, url):
+        row = self.conn.execute(
+            "SELECT etag, last_modified, stored_at, body FROM responses WHERE account = ? AND url = ?",
+            (account, url),
+        ).fetchone()
+        if row is None:
+            return None
+        self.conn.execute(
+            "UPDATE responses SET used_at = ? WHERE account = ? AND url = ?", (time.time(), account, url)
+        )
+        self.conn.commit()
+        return CacheEntry(*row)
+
+    def is_fresh(self, entry, url):
+        ttl = self.ttl_for(url)
+        return ttl is not None and time.time() - entry.stored_at < ttl
+
+    @staticmethod
+    def conditional_headers(entry):
+        headers = {}
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def store(self, account, url, headers, body):
+        now = time.time()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (account, url, headers.get('ETag'), headers.get('Last-Modified'), now, now, len(body), body),
+        )
+        self._evict()
+        self.conn.commit()
+
+    def refresh(self, account, url):
+        # A 304 confirmed the entry: restart its TTL
+        now = time.time()
+        self.conn.execute(
+            "UPDATE responses SET stored_at = ?, used_at = ? WHERE account = ? AND url = ?",
+            (now, now, account, url),
+        )
+        self.conn.commit()
+
+    def _evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for account, url, size in self.conn.execute(
+            "SELECT account, url, size FROM responses ORDER BY used_at"
+        ).fetchall():
+            self.conn.execute("DELETE FROM responses WHERE account = ? AND url = ?", (account, url))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def summary(self):
+        return f"HTTP cache: {self.hits} hits, {self.revalidated} revalidated (304), {self.misses} misses"
+
+    def close(self):
+        self.conn.close()
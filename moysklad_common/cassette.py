@@ -0,0 +1,258 @@
+"""
+Record/replay of MoySklad HTTP traffic ("cassettes") for offline runs.
+
+A cassette is a gzip-compressed JSON file with every request/response pair
+of a run. Scripts wrap their ClientSession with Cassette.wrap():
+
+    --record run.json.gz    talk to the API and save all traffic on exit
+    --replay run.json.gz    serve the saved responses, no network access
+    --no-delay              with --replay, answer at once instead of with
+                            the recorded response times
+
+Responses are matched by method and URL (query included) and handed out
+in recorded order; once a URL's responses are used up the last one is
+repeated. Request headers are never stored and access tokens in
+/security/token responses are replaced by a placeholder.
+
+Saved API responses (e.g. response.json) can seed a cassette; the URL is
+taken from the fixture's meta.href. From the repository root:
+
+    python -m moysklad_common.cassette seed assortment.json.gz response.json
+"""
+import argparse
+import asyncio
+import gzip
+import json
+from http import HTTPStatus
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+REDACTED_TOKEN = "replayed-token"
+# Describe the wire format, not the decoded body that is stored
+DROPPED_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "set-cookie"}
+
+
+class CassetteMissError(aiohttp.ClientError):
+    """A replayed run asked for a request the cassette does not contain."""
+
+
+class Cassette:
+    def __init__(self, path: str, replay: bool = False, delay: bool = True):
+        self.path = path
+        self.replay = replay
+        self.delay = delay
+        self.interactions: List[Dict[str, Any]] = []
+        self._played: Dict[Any, int] = {}
+        self._index: Dict[Any, List[Dict[str, Any]]] = {}
+        if replay:
+            self.load()
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> Optional['Cassette']:
+        if args.replay:
+            return cls(args.replay, replay=True, delay=not args.no_delay)
+        if args.record:
+            return cls(args.record)
+        return None
+
+    @staticmethod
+    def add_arguments(parser: argparse.ArgumentParser) -> None:
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument('--record', metavar='CASSETTE', help='save all HTTP traffic of the run to CASSETTE')
+        group.add_argument('--replay', metavar='CASSETTE', help='serve HTTP responses from CASSETTE instead of the API')
+        parser.add_argument('--no-delay', action='store_true', help='with --replay, skip the recorded response times')
+
+    def load(self) -> None:
+        with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+            self.interactions = json.load(f)['interactions']
+        self._index = {}
+        for interaction in self.interactions:
+            key = (interaction['method'], interaction['url'])
+            self._index.setdefault(key, []).append(interaction)
+
+    def save(self) -> None:
+        with gzip.open(self.path, 'wt', encoding='utf-8') as f:
+            json.dump({'version': 1, 'interactions': self.interactions}, f, ensure_ascii=False)
+
+    def add(self, method: str, url: str, status: int, headers, body: bytes, elapsed: float) -> None:
+        if url.rstrip('/').endswith('/security/token') and status in (200, 201):
+            body = json.dumps({'access_token': REDACTED_TOKEN}).encode()
+        self.interactions.append({
+            'method': method,
+            'url': str(URL(url)),
+            'status': status,
+            'headers': {k: v for k, v in headers.items() if k.lower() not in DROPPED_HEADERS},
+            'body': body.decode('utf-8', errors='replace'),
+            'elapsed': round(elapsed, 4),
+        })
+
+    def play(self, method: str, url: str) -> Dict[str, Any]:
+        key = (method, url)
+        recorded = self._index.get(key)
+        if not recorded:
+            raise CassetteMissError(f"{method} {url} is not in cassette {self.path}")
+        played = self._played.get(key, 0)
+        self._played[key] = played + 1
+        return recorded[min(played, len(recorded) - 1)]
+
+    def wrap(self, session: aiohttp.ClientSession) -> 'CassetteSession':
+        return CassetteSession(self, session)
+
+
+class CassetteStream:
+    """The parts of aiohttp.StreamReader the scripts read responses through."""
+
+    def __init__(self, body: bytes):
+        self._body = body
+        self.total_bytes = 0
+
+    async def read(self, n: int = -1) -> bytes:
+        start = self.total_bytes
+        end = len(self._body) if n < 0 else min(len(self._body), start + n)
+        self.total_bytes = end
+        return self._body[start:end]
+
+    async def iter_chunked(self, n: int):
+        while self.total_bytes < len(self._body):
+            yield await self.read(n)
+
+
+class CassetteResponse:
+    """A recorded response with the ClientResponse interface used by the scripts."""
+
+    def __init__(self, method: str, url: str, interaction: Dict[str, Any]):
+        self.method = method
+        self.url = URL(url)
+        self.status = interaction['status']
+        self.reason = HTTPStatus(self.status).phrase if self.status in HTTPStatus._value2member_map_ else ''
+        self.headers = CIMultiDictProxy(CIMultiDict(interaction['headers']))
+        self._body = interaction['body'].encode('utf-8')
+        self.content = CassetteStream(self._body)
+
+    async def read(self) -> bytes:
+        return self._consume()
+
+    async def text(self, encoding: str = 'utf-8') -> str:
+        return self._consume().decode(encoding)
+
+    async def json(self, loads=json.loads, **kwargs) -> Any:
+        body = self._consume()
+        return loads(body.decode('utf-8')) if body else None
+
+    def _consume(self) -> bytes:
+        # Like aiohttp, reading the whole body counts it in content.total_bytes,
+        # which the request metrics of final.py report
+        self.content.total_bytes = len(self._body)
+        return self._body
+
+    def raise_for_status(self) -> None:
+        if self.status >= 400:
+            request_info = aiohttp.RequestInfo(self.url, self.method, CIMultiDictProxy(CIMultiDict()), self.url)
+            raise aiohttp.ClientResponseError(
+                request_info, (), status=self.status, message=self.reason, headers=self.headers
+            )
+
+    def release(self) -> None:
+        pass
+
+    async def __aenter__(self) -> 'CassetteResponse':
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        pass
+
+
+class _CassetteRequest:
+    # Like aiohttp's request context manager: usable with `await` and `async with`
+    def __init__(self, coro):
+        self._coro = coro
+
+    def __await__(self):
+        return self._coro.__await__()
+
+    async def __aenter__(self) -> CassetteResponse:
+        self._response = await self._coro
+        return self._response
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        pass
+
+
+class CassetteSession:
+    """
+    Stands in for a ClientSession. When recording, requests go through the
+    wrapped session and their responses are stored; when replaying, the
+    wrapped session is never used. Closing it saves a recorded cassette.
+    """
+
+    def __init__(self, cassette: Cassette, session: aiohttp.ClientSession):
+        self.cassette = cassette
+        self.session = session
+
+    @property
+    def closed(self) -> bool:
+        return self.session.closed
+
+    def get(self, url, **kwargs) -> _CassetteRequest:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs) -> _CassetteRequest:
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method: str, url, **kwargs) -> _CassetteRequest:
+        return _CassetteRequest(self._request(method, url, **kwargs))
+
+    async def _request(self, method: str, url, params=None, **kwargs) -> CassetteResponse:
+        url = URL(url)
+        if params:
+            url = url.update_query(params)
+        url = str(url)
+        loop = asyncio.get_running_loop()
+        if self.cassette.replay:
+            interaction = self.cassette.play(method, url)
+            if self.cassette.delay and interaction['elapsed'] > 0:
+                await asyncio.sleep(interaction['elapsed'])
+            return CassetteResponse(method, url, interaction)
+
+        started = loop.time()
+        async with self.session.request(method, url, **kwargs) as response:
+            body = await response.read()
+            self.cassette.add(method, url, response.status, response.headers, body, loop.time() - started)
+        return CassetteResponse(method, url, self.cassette.interactions[-1])
+
+    async def close(self) -> None:
+        await self.session.close()
+        if not self.cassette.replay:
+            self.cassette.save()
+
+    async def __aenter__(self) -> 'CassetteSession':
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.close()
+
+
+def seed(path: str, fixtures: List[str]) -> None:
+    """Build a cassette from saved API responses, one GET per fixture."""
+    cassette = Cassette(path)
+    for fixture in fixtures:
+        with open(fixture, 'rb') as f:
+            body = f.read()
+        url = json.loads(body)['meta']['href']
+        cassette.add('GET', url, 200, {'Content-Type': 'application/json'}, body, 0.0)
+        print(f"GET {url} <- {fixture}")
+    cassette.save()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    seed_parser = subparsers.add_parser('seed', help='build a cassette from saved API responses')
+    seed_parser.add_argument('cassette')
+    seed_parser.add_argument('fixtures', nargs='+')
+    args = parser.parse_args()
+    if args.command == 'seed':
+        seed(args.cassette, args.fixtures)
@@ -0,0 +1,281 @@
+"""
+Request pacing for the MoySklad API, shared by all scripts: a governor
+that every request goes through, driven by the API's rate-limit headers,
+and the adaptive limit on requests in flight that it enforces.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+PARALLEL_REQUESTS = 5  # MoySklad allows 5 parallel requests per user
+
+
+class AdaptiveConcurrency:
+    """
+    Concurrency limit that follows what the API can take right now, never
+    above `max_limit`. With the default bounds the limit starts at
+    MoySklad's 5 parallel requests per user, so it only adapts downwards -
+    when another integration shares the quota or the API slows down - and
+    climbs back to 5 once that passes. Going above the quota would only
+    buy 429s, which pause every request.
+
+    - Additive increase: every healthy response adds `increase / limit`, so
+      the limit grows by about `increase` per round of requests. Only while
+      the limit is actually used up; otherwise a response says nothing
+      about whether more requests would be fine.
+    - Multiplicative decrease: a 429, a timeout or connection error, or a
+      smoothed latency above `latency_tolerance` times its baseline
+      multiplies the limit by `decrease`.
+    - One cut per round: signals from requests sent before the last cut
+      were caused by the old limit and are ignored.
+
+    Latency is the time to the response headers (decoding the body is our
+    CPU, not the API's load), tracked per endpoint since a page of 1000 rows
+    and a single entity take very different times. The baseline is the
+    lowest smoothed latency seen, drifting slowly upwards so a lasting
+    change on the API side stops counting as congestion.
+    """
+
+    def __init__(self, initial: int = PARALLEL_REQUESTS, min_limit: int = 1, max_limit: int = PARALLEL_REQUESTS,
+                 increase: float = 1.0, decrease: float = 0.5, latency_tolerance: float = 2.0,
+                 smoothing: float = 0.2, drift: float = 0.001, warmup: int = 5):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        self.drift = drift
+        self.warmup = warmup
+        self.increases = 0
+        self.decreases: Dict[str, int] = {}          # cuts by reason
+        self.history: List[Tuple[float, int]] = []   # (seconds into the run, limit) at every change
+        self._value = float(min(max(initial, min_limit), max_limit))
+        self._started = self._changed_at = time.monotonic()
+        self._limit_seconds = 0.0
+        self._last_cut = float('-inf')
+        self._latency: Dict[str, Dict[str, float]] = {}
+        self.history.append((0.0, self.limit))
+
+    @property
+    def limit(self) -> int:
+        return int(self._value)
+
+    @property
+    def adaptive(self) -> bool:
+        return self.min_limit < self.max_limit
+
+    def _set(self, value: float) -> None:
+        now = time.monotonic()
+        previous = self.limit
+        self._limit_seconds += previous * (now - self._changed_at)
+        self._changed_at = now
+        self._value = min(max(value, self.min_limit), self.max_limit)
+        if self.limit != previous:
+            self.history.append((round(now - self._started, 3), self.limit))
+
+    def record_latency(self, endpoint: str, seconds: float, sent_at: float, saturated: bool) -> None:
+        """A response that was not throttled; `sent_at` is its time.monotonic() at dispatch."""
+        if not self.adaptive:
+            return
+        stats = self._latency.setdefault(endpoint, {'smoothed': seconds, 'baseline': seconds, 'samples': 0})
+        if stats['samples'] == 0:
+            stats['smoothed'] = seconds
+        else:
+            stats['smoothed'] += self.smoothing * (seconds - stats['smoothed'])
+        stats['samples'] += 1
+        if stats['smoothed'] < stats['baseline']:
+            stats['baseline'] = stats['smoothed']
+        else:
+            stats['baseline'] += self.drift * (stats['smoothed'] - stats['baseline'])
+
+        if stats['samples'] >= self.warmup and stats['smoothed'] > self.latency_tolerance * stats['baseline']:
+            self.record_congestion('latency', sent_at)
+        elif saturated and sent_at >= self._last_cut and self._value < self.max_limit:
+            self.increases += 1
+            self._set(self._value + self.increase / self._value)
+
+    def record_congestion(self, reason: str, sent_at: float) -> None:
+        """A 429, a timeout/connection error or rising latency ('throttled', 'timeout', 'error', 'latency')."""
+        if not self.adaptive or sent_at < self._last_cut:
+            return
+        self._last_cut = time.monotonic()
+        self.decreases[reason] = self.decreases.get(reason, 0) + 1
+        previous = self.limit
+        self._set(self._value * self.decrease)
+        # The smoothed latencies still describe the old limit
+        for stats in self._latency.values():
+            stats['samples'] = 0
+        logging.info(f"Concurrency limit {previous} -> {self.limit} ({reason})")
+
+    def mean_limit(self) -> float:
+        elapsed = time.monotonic() - self._changed_at
+        total = time.monotonic() - self._started
+        return (self._limit_seconds + self.limit * elapsed) / total if total else float(self.limit)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'limit': self.limit,
+            'min_limit': self.min_limit,
+            'max_limit': self.max_limit,
+            'mean_limit': round(self.mean_limit(), 2),
+            'increases': self.increases,
+            'decreases': dict(sorted(self.decreases.items())),
+            'history': [list(change) for change in self.history],
+        }
+
+
+class RateLimitGovernor:
+    """
+    Shared pacing for every request sent to MoySklad.
+
+    At most `concurrency.limit` requests are in flight; without an
+    AdaptiveConcurrency the limit stays at `max_concurrency`. Each response
+    reports how much of the rate-limit window is left: while the budget is
+    comfortable requests go out back to back, once it drops to
+    `low_watermark` dispatches are spaced so the rest of the budget lasts
+    until the window resets, and a 429 pauses everyone for as long as the
+    API asks.
+    """
+
+    def __init__(self, max_concurrency: int = PARALLEL_REQUESTS, low_watermark: Optional[int] = None,
+                 concurrency: Optional[AdaptiveConcurrency] = None):
+        self.concurrency = concurrency or AdaptiveConcurrency(max_concurrency, max_concurrency, max_concurrency)
+        self.max_concurrency = self.concurrency.max_limit
+        # Keep two rounds of slots in reserve before pacing kicks in
+        self.low_watermark = 2 * self.max_concurrency if low_watermark is None else low_watermark
+        self.remaining: Optional[int] = None
+        self.throttled = 0          # 429 responses seen
+        self.waited_seconds = 0.0   # time requests spent held back by the governor
+        self.busy_seconds = 0.0     # slot-seconds spent with a request in flight
+        self._busy_since = 0.0
+        self._taken = 0             # slots held, in flight or waiting for a pause to end
+        self._waiters: deque = deque()
+        self._in_flight = 0
+        self._paused_until = 0.0    # loop time before which nothing may be sent
+        self._next_dispatch = 0.0   # earliest time for the next request while pacing
+        self._spacing = 0.0         # gap between dispatches while pacing
+
+    async def __aenter__(self):
+        await self._acquire()
+        try:
+            loop = asyncio.get_running_loop()
+            queued_at = loop.time()
+            # Re-check after every sleep: a pause may have been extended and
+            # another waiter may have taken the next dispatch time meanwhile.
+            while (delay := max(self._paused_until, self._next_dispatch) - loop.time()) > 0:
+                await asyncio.sleep(delay)
+            self._next_dispatch = loop.time() + self._spacing
+            self.waited_seconds += loop.time() - queued_at
+        except BaseException:
+            self._release()
+            raise
+        self._account_busy()
+        self._in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._account_busy()
+        self._in_flight -= 1
+        self._release()
+
+    async def _acquire(self) -> None:
+        # FIFO like a semaphore, but against a limit that can move
+        if not self._waiters and self._taken < self.concurrency.limit:
+            self._taken += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter  # _wake() takes the slot on our behalf
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                self._release()  # handed a slot just as we were cancelled
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+
+    def _release(self) -> None:
+        self._taken -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._waiters and self._taken < self.concurrency.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._taken += 1
+                waiter.set_result(None)
+
+    @property
+    def saturated(self) -> bool:
+        """Every slot is taken (or requests are queued for one)."""
+        return bool(self._waiters) or self._taken >= self.concurrency.limit
+
+    def _account_busy(self) -> None:
+        now = asyncio.get_running_loop().time()
+        if self._in_flight:
+            self.busy_seconds += self._in_flight * (now - self._busy_since)
+        self._busy_since = now
+
+    def pause(self, seconds: float) -> None:
+        """Hold back all new requests for `seconds` (never shortens an existing pause)."""
+        resume_at = asyncio.get_running_loop().time() + seconds
+        self._paused_until = max(self._paused_until, resume_at)
+
+    def update(self, status: int, headers) -> None:
+        """Feed the status and headers of a finished response into the governor."""
+        remaining = self._header(headers, 'X-RateLimit-Remaining')
+        if remaining is not None:
+            # The count was taken when this request arrived; the other
+            # requests in flight may already have drawn on it since.
+            self.remaining = int(remaining) - (self._in_flight - 1)
+
+        if status == 429:
+            self.throttled += 1
+            delay = self._retry_delay(headers)
+            logging.warning(f"Rate limit hit (429); pausing requests for {delay:.2f}s")
+            self.pause(delay)
+            self._spacing = self._window_spacing(headers)
+        elif self.remaining is not None and self.remaining <= self.low_watermark:
+            self._spacing = self._budget_spacing(headers)
+            if self.remaining <= 0:
+                self.pause(self._spacing)
+        else:
+            self._spacing = 0.0
+
+    @staticmethod
+    def _header(headers, name: str) -> Optional[float]:
+        try:
+            return float(headers[name])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def _retry_delay(self, headers) -> float:
+        # Retry-After is in seconds, the X-Lognex-* headers are in milliseconds
+        retry_after = self._header(headers, 'Retry-After')
+        if retry_after is not None:
+            return retry_after
+        for name in ('X-Lognex-Retry-After', 'X-Lognex-Retry-TimeInterval'):
+            value = self._header(headers, name)
+            if value is not None:
+                return value / 1000
+        return 1.0
+
+    def _window_spacing(self, headers) -> float:
+        # Time the window needs to free one request
+        interval = self._header(headers, 'X-Lognex-Retry-TimeInterval')
+        limit = self._header(headers, 'X-RateLimit-Limit')
+        if interval and limit:
+            return interval / 1000 / limit
+        return 0.1
+
+    def _budget_spacing(self, headers) -> float:
+        # Spread what is left of the budget over the time until the window
+        # resets, but never faster than the sustained rate the window allows
+        spacing = self._window_spacing(headers)
+        reset = self._header(headers, 'X-Lognex-Reset')
+        if reset is not None:
+            spacing = max(spacing, reset / 1000 / (max(self.remaining, 0) + 1))
+        return spacing
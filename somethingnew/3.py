@@ -284,16 +284,6 @@ async def fetch(
                 response.raise_for_status()
                 return await response.json()
             
-        except aiohttp.ClientResponseError as e:
-            logging.error(f"🚨 Request failed ({e.status}) for {url}: {e}")
-            return None
-        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-            logging.warning(f"⚠️ Attempt {attempt + 1} failed: {e}")
-            if attempt < retries - 1:
-                await asyncio.sleep(1)  # Short delay before retrying
-            else:
-                logging.error(f"❌ All {retries} attempts failed for {url}")
-                return None
         except aiohttp.ClientResponseError as e:
             # Handle "Too Many Requests" response
             if e.status == 429:
@@ -0,0 +1,102 @@
+"""
+Benchmark: fixed vs adaptive (AIMD) concurrency in final.py.
+
+fetch_all_products() runs against the stand-in (standin.py) in three
+conditions, once with the limit fixed at START_REQUESTS and once with
+AdaptiveConcurrency between MIN_REQUESTS and MAX_REQUESTS:
+
+    quiet      the API allows MoySklad's 5 parallel requests and nothing
+               else uses them
+    shared     another integration uses part of the parallel-request quota,
+               so the stand-in answers 429 above --shared-limit in flight
+    congested  the backend slows down once more than --capacity requests
+               are in flight (latency grows with the queue)
+
+MAX_REQUESTS is the API's quota of 5, so the adaptive limit can only go
+below the fixed one: "quiet" shows what adapting costs when nothing is
+wrong, the other two what it saves. The report shows wall time, request
+rate, 429s, the p90 latency and the final and mean concurrency limit of
+each run. Pages are small by default so the stand-in's latency, not
+decoding on our side, sets the pace.
+
+    python bench_concurrency.py --items 20000 --page-size 100 --latency 0.2
+"""
+import argparse
+import asyncio
+import time
+
+from aiohttp import ClientSession, ClientTimeout
+
+import final
+from standin import Catalog, StandIn
+
+
+class CongestedStandIn(StandIn):
+    """Latency grows with the number of requests in flight beyond `capacity`."""
+
+    def __init__(self, *args, capacity: int = 4, **kwargs):
+        self.capacity = capacity
+        super().__init__(*args, **kwargs)
+
+    @property
+    def latency(self) -> float:
+        return self.base_latency * max(1.0, self._in_flight / self.capacity)
+
+    @latency.setter
+    def latency(self, value: float) -> None:
+        self.base_latency = value
+
+
+async def fetch_once(server, adaptive: bool, page_size: int) -> dict:
+    concurrency = final.AdaptiveConcurrency(final.START_REQUESTS, final.MIN_REQUESTS, final.MAX_REQUESTS) if adaptive else None
+    final.governor = final.RateLimitGovernor(max_concurrency=final.START_REQUESTS, concurrency=concurrency)
+    final.resilience = final.ResiliencePolicy()
+    final.metrics = final.RequestMetrics()
+    server.reset_stats()
+    async with ClientSession(timeout=ClientTimeout(total=120)) as session:
+        start = time.perf_counter()
+        items = await final.fetch_all_products(session, server.url('entity/assortment'), limit=page_size)
+        elapsed = time.perf_counter() - start
+    snapshot = final.metrics.snapshot()
+    latency = snapshot['endpoints'].get('entity/assortment', {}).get('latency_seconds', {})
+    return {
+        'rows': len(items),
+        'seconds': elapsed,
+        'requests': server.stats['requests'],
+        'throttled': server.stats['throttled'],
+        'p90': latency.get('p90', 0.0),
+        'limit': snapshot['slots']['concurrency']['limit'],
+        'mean_limit': snapshot['slots']['concurrency']['mean_limit'],
+    }
+
+
+async def run(args) -> None:
+    scenarios = (
+        ('quiet', lambda: StandIn(Catalog(items=args.items), latency=args.latency)),
+        ('shared', lambda: StandIn(Catalog(items=args.items), latency=args.latency,
+                                   parallel_limit=args.shared_limit)),
+        ('congested', lambda: CongestedStandIn(Catalog(items=args.items), latency=args.latency,
+                                               capacity=args.capacity)),
+    )
+    print(f"{args.items} items in pages of {args.page_size}, {args.latency}s latency, limits: fixed {final.START_REQUESTS}, "
+          f"adaptive {final.MIN_REQUESTS}-{final.MAX_REQUESTS}")
+    for name, make_server in scenarios:
+        async with make_server() as server:
+            for adaptive in (False, True):
+                result = await fetch_once(server, adaptive, args.page_size)
+                mode = 'adaptive' if adaptive else 'fixed'
+                print(f"{name:>10} {mode:>8}: {result['rows']} rows in {result['seconds']:.2f}s, "
+                      f"{result['requests'] / result['seconds']:.1f} req/s, {result['throttled']} x 429, "
+                      f"p90 {result['p90']:.3f}s, limit {result['limit']} (mean {result['mean_limit']:.1f})")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=20000)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.2, help='stand-in seconds per page')
+    parser.add_argument('--shared-limit', type=int, default=3,
+                        help='parallel requests left to us in the shared scenario')
+    parser.add_argument('--capacity', type=int, default=4,
+                        help='requests in flight before the congested backend slows down')
+    asyncio.run(run(parser.parse_args()))
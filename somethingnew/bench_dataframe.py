@@ -0,0 +1,145 @@
+"""
+Benchmark: building the output DataFrame from per-row dicts vs from
+ProductColumns in final.py, and the memory each keeps per row.
+
+The dict path is what main() used to do: the hand-written
+product_details() (bench_transform.py) per row, then
+one dict per row with a variable set of price keys and pd.DataFrame() over
+the list. The columnar path appends every page to a ProductColumns with
+transform_page() and calls to_dataframe(); "plain" is the same without
+interning INTERNED_COLUMNS. Pages of the stand-in's
+synthetic catalog (standin.Catalog) are generated one at a time and
+dropped after the transform, like the streaming pipeline does, so what
+stays in memory is the output of each path. Each path runs in its own
+process; wall time, CPU time and peak RSS per stage come from
+final.profiler. "B/row" is the size of what the transform keeps - the
+records or the ProductColumns - with every object counted once, divided
+by the rows; "page B/row" is the same for one page of projected rows as
+fetched, what the pipeline kept for the whole catalog before it streamed.
+
+    python bench_dataframe.py --items 1000000
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import final
+from bench_transform import product_details
+from standin import Catalog
+
+
+def pages(items, page_size):
+    catalog = Catalog(items=items)
+    order = catalog.order
+    for start in range(0, items, page_size):
+        yield [final.project_fields(catalog.item(n), final.ASSORTMENT_FIELDS) for n in order[start:start + page_size]]
+
+
+def deep_size(obj):
+    """Bytes of `obj` and everything it references, each object counted once."""
+    seen = set()
+    stack = [obj]
+    total = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        elif isinstance(obj, final.ProductColumns):
+            stack.extend((obj.buffers, obj.parent_id))
+        # str, numbers and array() hold no references
+    return total
+
+
+def page_bytes_per_row(page_size):
+    rows = next(pages(page_size, page_size))
+    return deep_size(rows) / len(rows)
+
+
+def dict_path(items, page_size):
+    final.profiler.start("transform")
+    results = []
+    for rows in pages(items, page_size):
+        results.extend(product_details(p) for p in rows
+                       if p.get('variantsCount', -1) > 0 or p.get('meta', {}).get('type') == 'variant')
+    bytes_per_row = deep_size(results) / len(results)
+    final.profiler.start("dataframe")
+    out_data = []
+    for r in results:
+        base_data = {
+            'Путь': r['path'],
+            'Наименование': r['name'],
+            'Категория': r['category'],
+            'Код товара': r['code'],
+            'Порядковый номер': None,
+            'Включено в план размещения': "-",
+            'Фото на серевере': "-",
+            'Дней на складе': r['days'],
+            'Остаток': r['stock'],
+            'ID': r['id'],
+            'EAN13': r['ean13']
+        }
+        for price_name, price_value in r['prices'].items():
+            base_data[price_name] = price_value
+        out_data.append(base_data)
+    df = final.pd.DataFrame(out_data)
+    final.profiler.stop()
+    return df, bytes_per_row
+
+
+def columnar_path(items, page_size, intern=True):
+    final.profiler.start("transform")
+    spec = final.OUTPUT_SPEC if intern else [final.ColumnSpec(*column) for column in final.OUTPUT_COLUMNS]
+    columns = final.ProductColumns(spec)
+    for rows in pages(items, page_size):
+        final.transform_page(rows, None, columns)
+    bytes_per_row = deep_size(columns) / len(columns)
+    final.profiler.start("dataframe")
+    df = columns.to_dataframe()
+    final.profiler.stop()
+    return df, bytes_per_row
+
+
+def run_child(mode, items, page_size):
+    os.chdir(tempfile.mkdtemp())  # app.log of the child goes here
+    if mode == 'dicts':
+        df, bytes_per_row = dict_path(items, page_size)
+    else:
+        df, bytes_per_row = columnar_path(items, page_size, intern=mode == 'columns')
+    print(json.dumps({'rows': len(df), 'columns': len(df.columns), 'stages': final.profiler.stages,
+                      'bytes_per_row': bytes_per_row}))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 5 and sys.argv[1] == '--child':
+        run_child(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+        sys.exit(0)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=1000000)
+    parser.add_argument('--page-size', type=int, default=final.PAGE_SIZE)
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)),
+                                                                   os.environ.get('PYTHONPATH')])))
+    print(f"{args.items} catalog items, page B/row {page_bytes_per_row(args.page_size):.0f}")
+    print(f"  {'path':<8}{'rows':>9}  {'transform s':>12}{'build s':>9}{'build peak MB':>15}{'total peak MB':>15}"
+          f"{'B/row':>8}")
+    for mode in ('dicts', 'plain', 'columns'):
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', mode, str(args.items), str(args.page_size)],
+            stdout=subprocess.PIPE, text=True, encoding='utf-8', check=True, env=env,
+        )
+        data = json.loads(result.stdout.strip().splitlines()[-1])
+        transform, build = data['stages']['transform'], data['stages']['dataframe']
+        print(f"  {mode:<8}{data['rows']:>9}  {transform['wall_seconds']:>12.2f}{build['wall_seconds']:>9.2f}"
+              f"{build['peak_rss_mb']:>15.0f}{max(transform['peak_rss_mb'], build['peak_rss_mb']):>15.0f}"
+              f"{data['bytes_per_row']:>8.0f}")
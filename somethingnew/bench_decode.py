@@ -0,0 +1,91 @@
+"""
+Benchmark: the JSON decoders final.py can use on a response body.
+
+Compares what aiohttp's response.json() does (decode the bytes to str,
+then json.loads), every decoder installed here working on the raw bytes
+(final.json_decoders(): orjson, msgspec, json) and the streaming,
+field-projecting decode_page() (ijson, used with STREAM_PAGES).
+
+Runs on the bundled response.json fixture and on a synthetic 1000-row
+page built by repeating its rows, reporting decode time and peak traced
+memory (the raw page bytes are allocated before tracing starts).
+
+    python bench_decode.py --fixture ../response.json
+"""
+import argparse
+import asyncio
+import copy
+import json
+import time
+import tracemalloc
+
+import final
+
+
+def synthetic_page(fixture, rows=1000):
+    page = copy.deepcopy(fixture)
+    page['rows'] = []
+    for i in range(rows):
+        row = copy.deepcopy(fixture['rows'][i % len(fixture['rows'])])
+        row['id'] = f'{i:08d}-0000-0000-0000-000000000000'
+        row['code'] = f'{i:06d}'
+        page['rows'].append(row)
+    page['meta']['size'] = rows
+    return json.dumps(page, ensure_ascii=False).encode('utf-8')
+
+
+async def chunked(body, size=final.DECODE_CHUNK_SIZE):
+    for start in range(0, len(body), size):
+        yield body[start:start + size]
+
+
+def response_json(body):
+    # aiohttp's ClientResponse.json(): str first, then the decoder
+    return json.loads(body.decode('utf-8'))
+
+
+def streaming_decode(body):
+    return asyncio.run(final.decode_page(chunked(body)))
+
+
+def measure(func, body, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(body)
+    elapsed = (time.perf_counter() - start) / repeat
+    tracemalloc.start()
+    func(body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def decoders():
+    candidates = [('response.json', response_json)]
+    candidates += list(final.json_decoders().items())
+    if final.ijson is not None:
+        candidates.append(('decode_page', streaming_decode))
+    return candidates
+
+
+def report(label, body, repeat):
+    print(f"{label} ({len(body) / 1024:.0f} KiB)")
+    base = None
+    for name, func in decoders():
+        elapsed, peak = measure(func, body, repeat)
+        base = base or elapsed
+        print(f"  {name:>14}: {elapsed * 1000:8.2f} ms  peak {peak / 1024:8.0f} KiB  {base / elapsed:6.2f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--fixture', default='../response.json')
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"final.py decodes with {final.json_decoder_name}")
+    with open(args.fixture, 'rb') as f:
+        raw = f.read()
+    report('fixture', raw, args.repeat)
+    report(f'synthetic {args.rows}-row page', synthetic_page(json.loads(raw), args.rows), args.repeat)
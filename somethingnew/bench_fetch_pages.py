@@ -0,0 +1,48 @@
+"""
+Benchmark: sequential vs parallel assortment pagination in final.py.
+
+Times fetch_all_products() in both modes against the stand-in
+(standin.py), which answers every page after a fixed delay and can
+enforce MoySklad's rate limit with the X-RateLimit-* / X-Lognex-* headers.
+Pages are small by default so the stand-in's latency, not decoding on our
+side, sets the pace.
+
+    python bench_fetch_pages.py --rows 100000 --latency 0.2 --rate-limit 45
+"""
+import argparse
+import asyncio
+import time
+
+from aiohttp import ClientSession, ClientTimeout
+
+import final
+from standin import Catalog, StandIn
+
+
+async def run(total_rows: int, latency: float, page_size: int, fail_offsets=(), rate_limit: int = 0) -> None:
+    server = StandIn(Catalog(items=total_rows), latency=latency, rate_limit=rate_limit,
+                     fail_offsets=fail_offsets)
+    async with server, ClientSession(timeout=ClientTimeout(total=120)) as session:
+        for parallel in (False, True):
+            server.reset_stats()
+            start = time.perf_counter()
+            items = await final.fetch_all_products(session, server.url('entity/assortment'), limit=page_size,
+                                                   parallel=parallel)
+            elapsed = time.perf_counter() - start
+            mode = 'parallel' if parallel else 'sequential'
+            stats = server.stats
+            print(f"{mode:>10}: {len(items)} rows in {elapsed:.2f}s, "
+                  f"{stats['requests'] / elapsed:.1f} req/s, {stats['throttled']} x 429")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds per page')
+    parser.add_argument('--fail-offset', type=int, action='append', default=[],
+                        help='answer this offset with HTTP 500 (repeatable)')
+    parser.add_argument('--rate-limit', type=int, default=0,
+                        help='requests allowed per 3s window, as MoySklad enforces (0 = unlimited)')
+    args = parser.parse_args()
+    asyncio.run(run(args.rows, args.latency, args.page_size, set(args.fail_offset), args.rate_limit))
@@ -0,0 +1,141 @@
+"""
+Benchmark: the whole final.py pipeline, stage by stage, on synthetic catalogs.
+
+For every catalog size a stand-in server (standin.py) is started in its own
+process and main() runs twice against it in a scratch directory, each run
+in a fresh process: the first run creates last.csv and the workbook, the
+second one - the steady state of a daily run - is measured. Wall time, CPU
+time and peak RSS of each stage of main() come from final.profiler.
+
+Results are compared with the baselines in bench_pipeline_baseline.json;
+the exit status is 1 when a stage got slower or bigger than its baseline
+by more than --threshold, or when a size or stage is missing on either
+side. Baselines are machine specific: record them with
+--update-baseline on the machine that runs the comparison. The committed
+baseline covers 10k and 100k items; peak RSS grows about linearly with
+the catalog (2.2 GB at 100k, in formatting), so 1M items needs a machine
+with 20+ GB of RAM and a baseline recorded there.
+
+    python bench_pipeline.py --sizes 10000 100000
+    python bench_pipeline.py --sizes 10000 --update-baseline
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from standin import StandInProcess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(HERE, 'bench_pipeline_baseline.json')
+# Differences below these are noise, whatever the relative change
+NOISE_FLOOR = {'wall_seconds': 0.1, 'cpu_seconds': 0.1, 'peak_rss_mb': 20.0}
+
+
+def run_pipeline(server_url, workdir):
+    """Child process: one run of final.main() against the stand-in, stage results printed as JSON."""
+    os.chdir(workdir)  # before the import, so app.log lands in the scratch directory
+    sys.path.insert(0, HERE)
+    import final
+
+    final.base_url = f'{server_url}/entity/assortment'
+    final.TOKEN_URL = f'{server_url}/security/token'
+    final.TOKEN_FILE = os.path.join(workdir, 'tokens.json')
+    final.get_login = lambda: 'bench'
+    final.get_credentials = lambda username=None: ('bench', 'bench')
+    asyncio.run(final.main())
+    print(json.dumps(final.profiler.stages))
+
+
+def pipeline_process(server_url, workdir):
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', server_url, workdir],
+        stdout=subprocess.PIPE, text=True, encoding='utf-8', check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def measure(items, latency):
+    with tempfile.TemporaryDirectory() as workdir, \
+            StandInProcess('--items', items, '--latency', latency) as server:
+        pipeline_process(server.base_url, workdir)  # seeds last.csv and the workbook
+        return pipeline_process(server.base_url, workdir)
+
+
+def compare(results, baseline, threshold):
+    """Regressions beyond threshold, and what could not be compared because one side lacks it."""
+    regressions, missing = [], []
+    for size, stages in results.items():
+        if size not in baseline:
+            missing.append(f"{size} items: no baseline")
+            continue
+        for stage, values in stages.items():
+            base = baseline[size].get(stage)
+            if base is None:
+                missing.append(f"{size} items, {stage}: no baseline")
+                continue
+            for key, floor in NOISE_FLOOR.items():
+                if values[key] > base[key] * (1 + threshold) and values[key] - base[key] > floor:
+                    regressions.append(f"{size} items, {stage}: {key} {base[key]} -> {values[key]}")
+        for stage in baseline[size].keys() - stages.keys():
+            missing.append(f"{size} items, {stage}: in the baseline but not measured")
+    return regressions, missing
+
+
+def report(size, stages):
+    print(f"\n{size} items")
+    print(f"  {'stage':<16}{'wall s':>10}{'cpu s':>10}{'peak MB':>10}")
+    for stage, values in stages.items():
+        print(f"  {stage:<16}{values['wall_seconds']:>10.2f}{values['cpu_seconds']:>10.2f}{values['peak_rss_mb']:>10.0f}")
+    print(f"  {'total':<16}{sum(v['wall_seconds'] for v in stages.values()):>10.2f}"
+          f"{sum(v['cpu_seconds'] for v in stages.values()):>10.2f}"
+          f"{max(v['peak_rss_mb'] for v in stages.values()):>10.0f}")
+
+
+def main(args):
+    results = {}
+    for size in args.sizes:
+        results[str(size)] = measure(size, args.latency)
+        report(size, results[str(size)])
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    if args.update_baseline or not baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, indent=2)
+        print(f"\nBaseline written to {args.baseline}")
+        return 0
+
+    regressions, missing = compare(results, baseline, args.threshold)
+    if missing:
+        print(f"\nNot compared, re-record {args.baseline} with --update-baseline:")
+        for line in missing:
+            print(f"  {line}")
+    if regressions:
+        print(f"\nRegressions beyond {args.threshold:.0%}:")
+        for line in regressions:
+            print(f"  {line}")
+    if missing or regressions:
+        return 1
+    print(f"\nNo regressions beyond {args.threshold:.0%} against {args.baseline}")
+    return 0
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--child':
+        run_pipeline(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--latency', type=float, default=0.0, help='stand-in seconds per request')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed relative slowdown per stage')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--update-baseline', action='store_true')
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,91 @@
+"""
+Benchmark: decoding and transforming raw pages in this process vs in the
+process pool of final.py (TRANSFORM_PROCESSES).
+
+Raw pages of the stand-in's synthetic catalog (standin.Catalog) are
+serialized once. "in-process" is what main() does without the pool: every
+page decoded and projected to ASSORTMENT_FIELDS like read_page(), then
+transform_page(). The pool runs hand the bytes to transform_product_pages()
+with 1, 2, ... worker processes, already started, so the report shows the
+transform throughput and how it grows with workers. Workers transform
+whole decoded rows and skip the projection, which the in-process path
+needs to keep fetched pages small. "main CPU" is the CPU time this
+process spent meanwhile - what is left on the event loop.
+
+    python bench_processes.py --items 200000 --processes 1 2 4 8
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import final
+from standin import Catalog
+
+
+def make_bodies(items, page_size):
+    catalog = Catalog(items=items)
+    order = catalog.order
+    return [json.dumps({'meta': {'size': items}, 'rows': [catalog.item(n) for n in order[start:start + page_size]]},
+                       ensure_ascii=False).encode('utf-8')
+            for start in range(0, items, page_size)]
+
+
+async def in_process(bodies):
+    columns = final.ProductColumns()
+    index = final.PathIndex(path=None)
+    for offset, body in enumerate(bodies):
+        rows = [final.project_fields(row, final.ASSORTMENT_FIELDS) for row in final.json_loads(body)['rows']]
+        final.transform_page(rows, index, columns, offset)
+    return columns
+
+
+async def with_pool(bodies, pool, processes):
+    queue = asyncio.Queue(maxsize=final.PAGE_QUEUE_SIZE)
+
+    async def produce():
+        for offset, body in enumerate(bodies):
+            await queue.put((offset, body))
+        await queue.put(None)
+
+    producer = asyncio.create_task(produce())
+    columns = await final.transform_product_pages(queue, final.PathIndex(path=None), pool, processes)
+    await producer
+    return columns
+
+
+def measure(coro):
+    start, cpu = time.perf_counter(), time.process_time()
+    columns = asyncio.run(coro)
+    return time.perf_counter() - start, time.process_time() - cpu, columns
+
+
+def canonical(columns):
+    return columns.to_dataframe()  # in catalog order, whatever order the workers finished in
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=200000)
+    parser.add_argument('--page-size', type=int, default=final.PAGE_SIZE)
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4])
+    args = parser.parse_args()
+
+    bodies = make_bodies(args.items, args.page_size)
+    print(f"{args.items} items in {len(bodies)} pages of {args.page_size}, "
+          f"{sum(map(len, bodies)) / 2 ** 20:.0f} MB, {os.cpu_count()} cores")
+    base_time, base_cpu, columns = measure(in_process(bodies))
+    expected = canonical(columns)
+    print(f"  {'in-process':>12}: {base_time:7.2f}s  {args.items / base_time:9.0f} items/s  main CPU {base_cpu:6.2f}s")
+    for processes in args.processes:
+        pool = final.transform_pool(processes)
+        try:
+            # Start the workers (and compile their extractors) before timing
+            list(pool.map(final.transform_page_bytes, [b'{"rows": []}'] * processes))
+            elapsed, cpu, columns = measure(with_pool(bodies, pool, processes))
+        finally:
+            pool.shutdown()
+        same = canonical(columns).equals(expected)
+        print(f"  {f'{processes} workers':>12}: {elapsed:7.2f}s  {args.items / elapsed:9.0f} items/s  main CPU {cpu:6.2f}s  "
+              f"x{base_time / elapsed:.2f}  {'same rows' if same else 'ROWS DIFFER'}")
@@ -0,0 +1,73 @@
+"""
+Benchmark: flat-sleep retries vs the ResiliencePolicy in final.py under an
+injected outage.
+
+The stand-in (standin.py) answers 503 for every request that arrives
+during the outage window, then recovers. Like an overloaded backend,
+every request received during the outage pushes the recovery back by
+--penalty seconds. Both policies fetch the same catalog;
+the report shows wall time, when the server recovered, how long after
+that the run finished, how many requests hit the server during the
+outage (wasted) and how many pages were lost.
+
+    python bench_resilience.py --pages 100 --outage-start 0.5 --outage 3 --penalty 0.02
+"""
+import argparse
+import asyncio
+import time
+
+from aiohttp import ClientSession, ClientTimeout
+
+import final
+from standin import Catalog, StandIn
+
+
+class FlatRetryPolicy(final.ResiliencePolicy):
+    """The previous behaviour: every failure retried after a flat 1 s, no budget, no breaker."""
+
+    def __init__(self):
+        super().__init__(failure_threshold=float('inf'))
+
+    def try_retry(self):
+        self.retries += 1
+        return True
+
+    async def backoff(self, attempt):
+        await asyncio.sleep(1)
+
+
+async def run(pages, page_size, latency, outage_start, outage_length, penalty, cooldown):
+    server = StandIn(Catalog(items=pages * page_size), latency=latency,
+                     outage_start=outage_start, outage=outage_length, penalty=penalty)
+    policies = (
+        ('flat 1s retry', FlatRetryPolicy),
+        ('resilience', lambda: final.ResiliencePolicy(base_delay=0.25, cooldown=cooldown)),
+    )
+    async with server, ClientSession(timeout=ClientTimeout(total=30)) as session:
+        for label, make_policy in policies:
+            final.resilience = make_policy()
+            final.governor = final.RateLimitGovernor(max_concurrency=final.START_REQUESTS)
+            server.reset_stats()  # restarts the clock the outage window is measured on
+            items = await final.fetch_all_products(session, server.url('entity/assortment'), limit=page_size)
+            elapsed = time.monotonic() - server.started
+            recovery = max(elapsed - server.outage_end, 0)
+            stats = server.stats
+            print(f"{label:>14}: {elapsed:5.2f}s total, server recovered at {server.outage_end:5.2f}s, "
+                  f"finished {recovery:5.2f}s later, "
+                  f"{stats['requests']} requests ({stats['outage']} during outage), "
+                  f"{pages - len(items) // page_size} pages lost, "
+                  f"circuit opened {final.resilience.circuit_opened}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--pages', type=int, default=100)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per healthy page')
+    parser.add_argument('--outage-start', type=float, default=0.5)
+    parser.add_argument('--outage', type=float, default=3.0, help='outage length in seconds')
+    parser.add_argument('--penalty', type=float, default=0.02,
+                        help='seconds each request during the outage adds to it')
+    parser.add_argument('--cooldown', type=float, default=1.0, help='circuit breaker cooldown')
+    args = parser.parse_args()
+    asyncio.run(run(args.pages, args.page_size, args.latency, args.outage_start, args.outage, args.penalty, args.cooldown))
@@ -0,0 +1,206 @@
+"""
+Benchmark: per-product coroutines vs the batch transform_page() in final.py,
+and hand-written field extraction vs extractors compiled from OUTPUT_COLUMNS.
+
+The coroutine path is what main() used to do with a page: one coroutine
+per product behind a semaphore, driven through asyncio.as_completed with
+a tqdm update per product, base products first and then variants. The
+batch path hands the same page to transform_page() in one call,
+appending to one ProductColumns. "hand-written"
+is the batch path with the .get() chains ProductColumns.append() had
+before the column spec. "floor" calls product_details(), the old
+hand-written extraction, in a bare loop: the extraction work itself, so
+path minus floor is the per-row overhead of the path. Rows come from the
+stand-in's synthetic catalog (standin.Catalog), projected to
+ASSORTMENT_FIELDS like fetched pages are.
+
+    python bench_transform.py --items 100000
+"""
+import argparse
+import asyncio
+import math
+import sys
+import time
+
+from tqdm.asyncio import tqdm
+
+import final
+from standin import Catalog
+
+
+def product_details(product):
+    """The hand-written extraction main() used before OUTPUT_COLUMNS: one dict per row."""
+    path_name, parent_id = product.get('pathName', ""), None
+    if product.get('meta', {}).get('type') == 'variant':
+        path_name, parent_id = "", final.variant_parent_id(product)
+
+    category_value = "base"
+    for char in product.get('characteristics', []):
+        category_value = str(char.get('value', 'base'))
+        break
+
+    prices = {
+        p.get('priceType', {}).get('name', 'Unknown'): (p.get('value', 0) / 100)
+        for p in product.get('salePrices', [])
+        if p.get('priceType', {}).get('name') in PRICE_SET
+    }
+    return {
+        'name': product.get('name'),
+        'code': product.get('code'),
+        'path': path_name,
+        'stock': product.get('stock', 0),
+        'days': product.get('stockDays', 0),
+        'category': category_value,
+        'prices': prices,
+        'id': product.get('id'),
+        'ean13': final.barcodes(product.get("barcodes", [])),
+        'parent_id': parent_id
+    }
+
+
+class HandWrittenColumns(final.ProductColumns):
+    """ProductColumns with the hand-written append() it had before OUTPUT_COLUMNS."""
+
+    def __init__(self):
+        super().__init__()
+        self._price_slot = {name: i for i, name in enumerate(final.INCLUDED_PRICE_TYPES)}
+        self._prices = [self.buffers[name] for name in final.INCLUDED_PRICE_TYPES]
+        self._name, self._category, self._code = (self.buffers[name] for name in ('Наименование', 'Категория', 'Код товара'))
+        self._ean13, self._stock, self._days = (self.buffers[name] for name in ('EAN13', 'Остаток', 'Дней на складе'))
+
+    def append(self, product, page_offset=0):
+        if product.get('meta', {}).get('type') == 'variant':
+            path_name, parent_id = "", final.variant_parent_id(product)
+        else:
+            path_name, parent_id = product.get('pathName', ""), None
+
+        category_value = "base"
+        for char in product.get('characteristics', []):
+            category_value = str(char.get('value', 'base'))
+            break
+
+        prices = [math.nan] * len(self._prices)
+        for p in product.get('salePrices', []):
+            slot = self._price_slot.get(p.get('priceType', {}).get('name'))
+            if slot is not None:
+                prices[slot] = p.get('value', 0) / 100
+
+        barcodes_list = product.get("barcodes", [])
+        ean13_codes = [barcode.get("ean13") for barcode in barcodes_list if "ean13" in barcode]
+        if ean13_codes:
+            barcode_value = ",".join(ean13_codes)
+        elif barcodes_list:
+            barcode_value = ",".join(list(barcodes_list[0].keys()))
+        else:
+            barcode_value = ""
+
+        stock = product.get('stock', 0)
+        stock = math.nan if stock is None else float(stock)
+        days = int(product.get('stockDays') or 0)
+
+        self.path.append(path_name)
+        self.parent_id.append(parent_id)
+        self._category.append(category_value)
+        self._ean13.append(barcode_value)
+        self._stock.append(stock)
+        self._days.append(days)
+        self._name.append(product.get('name'))
+        self._code.append(product.get('code'))
+        self.id.append(product.get('id'))
+        for column, value in zip(self._prices, prices):
+            column.append(value)
+        self.page_offset.append(page_offset)
+
+
+PRICE_SET = frozenset(final.INCLUDED_PRICE_TYPES)
+
+
+def make_pages(items, page_size):
+    catalog = Catalog(items=items)
+    rows = [final.project_fields(catalog.item(n), final.ASSORTMENT_FIELDS) for n in catalog.order]
+    return [rows[start:start + page_size] for start in range(0, len(rows), page_size)]
+
+
+async def coroutine_path(pages):
+    semaphore = asyncio.Semaphore(final.START_REQUESTS)
+    results = []
+
+    async def limited(product):
+        async with semaphore:
+            return product_details(product)
+
+    for rows in pages:
+        base_products = [p for p in rows if p.get('variantsCount', -1) > 0]
+        variants = [p for p in rows if p.get('meta', {}).get('type') == 'variant']
+        for group in (base_products, variants):
+            tasks = [limited(p) for p in group]
+            for coro in tqdm(asyncio.as_completed(tasks), total=len(tasks), leave=False, file=sys.stderr):
+                results.append(await coro)
+    return results
+
+
+async def floor(pages):
+    return [product_details(p) for rows in pages for p in rows
+            if p.get('variantsCount', -1) > 0 or p.get('meta', {}).get('type') == 'variant']
+
+
+async def batch_path(pages):
+    index = final.PathIndex()
+    columns = final.ProductColumns()
+    for rows in pages:
+        final.transform_page(rows, index, columns)
+    return columns
+
+
+async def hand_written_path(pages):
+    index = final.PathIndex()
+    columns = HandWrittenColumns()
+    for rows in pages:
+        final.transform_page(rows, index, columns)
+    return columns
+
+
+def canonical(results):
+    """The extracted values as sorted tuples, from product_details() records or ProductColumns."""
+    if isinstance(results, final.ProductColumns):
+        b = results.buffers
+        prices = zip(*(b[name] for name in final.INCLUDED_PRICE_TYPES))
+        rows = zip(b['ID'], b['Путь'], b['Наименование'], b['Код товара'], b['Категория'],
+                   b['Остаток'], b['Дней на складе'], b['EAN13'], prices)
+    else:
+        rows = ((r['id'], r['path'], r['name'], r['code'], r['category'], r['stock'], r['days'], r['ean13'],
+                 [r['prices'].get(name, math.nan) for name in final.INCLUDED_PRICE_TYPES]) for r in results)
+    return sorted(
+        (*row[:5], float(row[5]), int(row[6]), row[7], tuple(None if math.isnan(v) else v for v in row[8]))
+        for row in rows
+    )
+
+
+def measure(func, pages, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = asyncio.run(func(pages))
+        best = min(best, time.perf_counter() - start)
+    return best, results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=100000)
+    parser.add_argument('--page-size', type=int, default=final.PAGE_SIZE)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    pages = make_pages(args.items, args.page_size)
+    rows = sum(len(page) for page in pages)
+    print(f"{rows} rows in {len(pages)} pages of {args.page_size}")
+    base_time, expected = measure(floor, pages, args.repeat)
+    expected = canonical(expected)
+    print(f"  {'floor':>12}: {base_time:7.3f}s  {base_time / rows * 1e6:7.2f} us/row")
+    for name, func in (('coroutines', coroutine_path), ('hand-written', hand_written_path), ('batch', batch_path)):
+        elapsed, results = measure(func, pages, args.repeat)
+        same = canonical(results) == expected
+        print(f"  {name:>12}: {elapsed:7.3f}s  {elapsed / rows * 1e6:7.2f} us/row  "
+              f"overhead {(elapsed - base_time) / rows * 1e6:6.2f} us/row  "
+              f"{'same records' if same else 'RECORDS DIFFER'}")
@@ -1,3 +1,4 @@
+import argparse
 import openpyxl
 from openpyxl.worksheet.datavalidation import DataValidation
 from openpyxl.styles import PatternFill, Font, Alignment
@@ -5,28 +6,61 @@ from openpyxl.formatting.rule import CellIsRule
 from openpyxl.utils import get_column_letter
 import aiohttp
 import asyncio
+import numpy as np
 import pandas as pd
 from datetime import datetime
-from requests.auth import HTTPBasicAuth
 import logging
-from aiohttp import BasicAuth, ClientSession, ClientTimeout
+from aiohttp import ClientSession, ClientTimeout
 from tqdm.asyncio import tqdm
 import os
+import re
+import sys
+import json
+import time
+import copy
+import random
+import threading
+import math
+import multiprocessing
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 import getpass
-from typing import Any, Dict, Optional, List
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from typing import Any, Callable, Dict, Optional, List, Tuple
 import psutil
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # moysklad_common/
+from moysklad_common.auth import TOKEN_FILE, TOKEN_URL, TokenAuth
+from moysklad_common.cassette import Cassette
+from moysklad_common.ratelimit import AdaptiveConcurrency, RateLimitGovernor
 import sqlite3
 import smtplib
 from email.mime.text import MIMEText
 import traceback
 
+try:
+    import ijson  # optional: enables streaming page decoding
+except ImportError:
+    ijson = None
+try:
+    import orjson  # optional: decodes responses several times faster
+except ImportError:
+    orjson = None
+try:
+    import msgspec  # optional: alternative fast decoder
+except ImportError:
+    msgspec = None
+
 # -------------------------------------------------------------------------------
 # Logging Setup
 # -------------------------------------------------------------------------------
+# Set for the worker processes of the transform pool, which import this
+# module too: only the main process starts a fresh log
+TRANSFORM_WORKER_ENV = "MOYSKLAD_TRANSFORM_WORKER"
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
-    handlers=[logging.FileHandler('app.log', mode='w')]
+    handlers=[logging.FileHandler('app.log', mode='a' if os.environ.get(TRANSFORM_WORKER_ENV) else 'w')]
 )
 
 # -------------------------------------------------------------------------------
@@ -143,9 +177,8 @@ def add_dropdown_and_formatting(file_path: str, sheet_name: str) -> None:
     dv = DataValidation(type="list", formula1='"Да,Нет"', allow_blank=True)
     ws.add_data_validation(dv)
     for col in dropdown_columns:
-        for row in range(2, max_row + 1):
-            cell = f'{col}{row}'
-            dv.add(ws[cell])
+        # One range per column: adding cells one by one is quadratic in openpyxl
+        dv.add(f'{col}2:{col}{max_row}')
 
     # Conditional formatting for "Да" (green) and "Нет" (orange)
     green_fill = PatternFill(start_color="C6E0B4", end_color="C6E0B4", fill_type="solid")
@@ -212,16 +245,30 @@ def send_email_notification(subject: str, message: str):
 # -------------------------------------------------------------------------------
 MAX_LOGIN_ATTEMPTS = 3  # Maximum times user can retry
 
-def get_credentials():
+def get_login():
+    """
+    Prompt user for the account email. Every run names its account, so the
+    token cached for that account is used and never another one's.
+    """
+    for _ in range(MAX_LOGIN_ATTEMPTS):
+        username = input("🔑 Enter your email: ")
+        if username:
+            return username
+        print("⚠️ Email cannot be empty. Try again.")
+    print("❌ Too many failed attempts. Exiting...")
+    exit(1)
+
+def get_credentials(username: Optional[str] = None):
     """
-    Prompt user for login credentials securely. Limits retries.
+    Prompt user for login credentials securely. Limits retries. With a
+    `username` only its password is asked for.
     """
     attempts = 0
     while attempts < MAX_LOGIN_ATTEMPTS:
-        username = input("🔑 Enter your email: ")
+        login = username or input("🔑 Enter your email: ")
         password = getpass.getpass("🔒 Enter your password: ")
-        if username and password:
-            return username, password
+        if login and password:
+            return login, password
         print("⚠️ Credentials cannot be empty. Try again.")
         attempts += 1
     print("❌ Too many failed attempts. Exiting...")
@@ -230,18 +277,703 @@ def get_credentials():
 # -------------------------------------------------------------------------------
 # Initial Authentication Setup
 # -------------------------------------------------------------------------------
-USERNAME, PASSWORD = get_credentials()
-auth = BasicAuth(USERNAME, PASSWORD)
+# The auth is created in main() so the module can be imported (e.g. by
+# the benchmarks) without prompting. Without it requests go out
+# unauthenticated.
+auth: Optional[TokenAuth] = None
 
 base_url = "https://api.moysklad.ru/api/remap/1.2/entity/assortment"
-MAX_REQUESTS = 5        # Limit concurrent requests
+MAX_REQUESTS = 5        # Upper bound for concurrent requests: MoySklad allows 5 parallel requests per user
+MIN_REQUESTS = 1        # Lower bound for concurrent requests
+START_REQUESTS = 5      # Concurrent requests at the start of a run
+ADAPTIVE_CONCURRENCY = True  # Back off below MAX_REQUESTS under congestion (AIMD); False keeps START_REQUESTS
+MAX_THROTTLED_RETRIES = 20  # Retries of one request after 429s, on top of the failure retries
 PAGE_SIZE = 1000        # MoySklad max page size
+PARALLEL_PAGES = True   # Fetch remaining pages concurrently once meta.size is known
+PAGE_QUEUE_SIZE = 4     # Fetched pages waiting for the transform stage
+JSON_DECODER = "auto"   # "orjson", "msgspec" or "json"; "auto" takes the fastest one installed
+STREAM_PAGES = False    # Decode list pages with ijson as they arrive: least memory, but several times slower
 INCLUDED_PRICE_TYPES = [
     "Цена розница",
     "Цена маркетплейс",
     "Цена мелкий опт",
     "Цена средний опт"
 ]
+# Output columns in sheet order: (column, JSON path, transform, default).
+# A path is dot-separated keys of an assortment row; a number indexes a list
+# and list[key.path=value] takes the first element of `list` whose key.path
+# equals value. A missing or null value gets the default, anything else goes
+# through the transform: a callable or a name from TRANSFORMS ("kopecks",
+# "barcodes"). Columns without a path hold the default in every row. The
+# decoder keeps the fields these paths need, so a new column is one line here:
+#     ('Артикул', 'article', None, ""),
+#     ('Вес', 'weight', float, 0.0),
+#     ('Цвет', 'attributes[name=Цвет].value', str, ""),
+OUTPUT_COLUMNS = [
+    ('Путь', 'pathName', None, ""),  # variants get their parent's, see resolve_variant_paths()
+    ('Наименование', 'name', None, None),
+    ('Категория', 'characteristics.0.value', str, "base"),
+    ('Код товара', 'code', None, None),
+    ('Порядковый номер', None, None, None),
+    ('Включено в план размещения', None, None, "-"),
+    ('Фото на серевере', None, None, "-"),
+    ('Дней на складе', 'stockDays', int, 0),
+    ('Остаток', 'stock', float, 0.0),
+    ('ID', 'id', None, None),
+    ('EAN13', 'barcodes', 'barcodes', ""),
+    *[(name, f'salePrices[priceType.name={name}].value', 'kopecks', math.nan) for name in INCLUDED_PRICE_TYPES],
+]
+INTERNED_COLUMNS = {'Путь', 'Категория'}  # Repeated values stored once (sys.intern) instead of once per row
+TRANSFORM_PROCESSES = 0  # Worker processes that decode and transform raw pages; 0 keeps it all in this process, None uses every core
+PATH_INDEX_FILE = "path_index.json"  # Product paths by id, reused by the next run
+PARENT_BATCH_SIZE = 100  # Parent products fetched per request when their path is unknown
+
+# -------------------------------------------------------------------------------
+# Rate-limit governor shared by all requests (moysklad_common.ratelimit)
+# -------------------------------------------------------------------------------
+governor = RateLimitGovernor(
+    max_concurrency=START_REQUESTS,
+    concurrency=AdaptiveConcurrency(START_REQUESTS, MIN_REQUESTS, MAX_REQUESTS) if ADAPTIVE_CONCURRENCY else None
+)
+
+# -------------------------------------------------------------------------------
+# Run-wide resilience: jittered backoff, retry budget and circuit breaker
+# -------------------------------------------------------------------------------
+class ResiliencePolicy:
+    """
+    Retry policy shared by every request of a run.
+
+    - Backoff: full jitter, sleep uniform(0, min(max_delay, base_delay * 2**attempt)),
+      so tasks failing together do not retry in lockstep.
+    - Retry budget: retries after a failure (5xx, timeout, connection
+      error) may add at most `budget_ratio` of the first attempts made so
+      far (plus `min_retries` for short runs), so a degraded API does not
+      receive a multiple of the normal load. Retries after a 429 are paced
+      by the governor instead and capped per request (MAX_THROTTLED_RETRIES).
+    - Circuit breaker: after `failure_threshold` consecutive 5xx/timeouts no
+      request is sent for `cooldown` seconds; then a single probe goes out
+      and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, base_delay: float = 0.5, max_delay: float = 30.0, budget_ratio: float = 0.1,
+                 min_retries: int = 10, failure_threshold: int = 5, cooldown: float = 10.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.min_retries = min_retries
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.requests = 0        # first attempts
+        self.retries = 0         # extra attempts
+        self.budget_denied = 0   # retries refused because the budget ran out
+        self.circuit_opened = 0
+        self.state = 'closed'    # closed -> open -> half-open -> closed/open
+        self._failure_streak = 0
+        self._open_until = 0.0
+        self._changed = asyncio.Event()
+
+    def _set_state(self, state: str) -> None:
+        self.state = state
+        # Wake everyone waiting on the breaker so they re-check the new state
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def before_request(self) -> None:
+        """Wait until the circuit lets a request through."""
+        loop = asyncio.get_running_loop()
+        while self.state != 'closed':
+            if self.state == 'open' and loop.time() >= self._open_until:
+                self._set_state('half-open')  # this caller is the probe
+                return
+            timeout = max(self._open_until - loop.time(), 0) if self.state == 'open' else None
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def record_success(self) -> None:
+        """Any answer that is not a 5xx shows the API is up."""
+        self._failure_streak = 0
+        if self.state != 'closed':
+            logging.info("Circuit closed; resuming requests.")
+            self._set_state('closed')
+
+    def record_failure(self) -> None:
+        """A 5xx, timeout or connection error."""
+        self._failure_streak += 1
+        if self.state == 'half-open' or (self.state == 'closed' and self._failure_streak >= self.failure_threshold):
+            self.circuit_opened += 1
+            self._open_until = asyncio.get_running_loop().time() + self.cooldown
+            logging.warning(f"Circuit opened after {self._failure_streak} failures; pausing {self.cooldown:.0f}s")
+            self._set_state('open')
+
+    def try_retry(self) -> bool:
+        """Take one retry from the run-wide budget, if any is left."""
+        if self.retries >= self.min_retries + self.budget_ratio * self.requests:
+            self.budget_denied += 1
+            return False
+        self.retries += 1
+        return True
+
+    async def backoff(self, attempt: int) -> None:
+        await asyncio.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+
+resilience = ResiliencePolicy()
+
+# -------------------------------------------------------------------------------
+# Single-flight: identical concurrent GETs share one request
+# -------------------------------------------------------------------------------
+class SingleFlight:
+    """
+    Coalesces identical calls that overlap in time. The first caller runs
+    the request; callers arriving while it is in flight wait for it and get
+    their own deep copy of the result, so nobody can mutate another's data.
+    """
+
+    def __init__(self):
+        self.saved = 0  # requests that did not go out because one was in flight
+        self._calls: Dict[Any, asyncio.Future] = {}
+
+    async def do(self, key: Any, func):
+        future = self._calls.get(key)
+        if future is not None:
+            self.saved += 1
+            return copy.deepcopy(await asyncio.shield(future))
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await func()
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved when nobody else was waiting
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
+
+single_flight = SingleFlight()
+
+# -------------------------------------------------------------------------------
+# Per-endpoint request metrics, exported as JSON and Prometheus text
+# -------------------------------------------------------------------------------
+METRICS_JSON = "metrics.json"
+METRICS_PROM = "metrics.prom"
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+ID_SEGMENT = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+class RequestMetrics:
+    """
+    Request instrumentation for one run, grouped by endpoint (the API path
+    with entity ids replaced by ":id"): latency of every attempt, status
+    codes, transport errors, retries, time held back by the governor and
+    bytes received. Slot usage comes from the governor.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.endpoints: Dict[str, Dict[str, Any]] = {}
+        self.started = time.monotonic()
+
+    @staticmethod
+    def endpoint(url: str) -> str:
+        path = urlsplit(url).path.split('/api/remap/1.2/', 1)[-1].strip('/')
+        return '/'.join(':id' if ID_SEGMENT.fullmatch(part) else part for part in path.split('/'))
+
+    def _stats(self, url: str) -> Dict[str, Any]:
+        name = self.endpoint(url)
+        stats = self.endpoints.get(name)
+        if stats is None:
+            stats = self.endpoints[name] = {
+                'latencies': [], 'status': {}, 'errors': 0, 'retries': 0,
+                'wait_seconds': 0.0, 'bytes': 0,
+            }
+        return stats
+
+    @contextmanager
+    def track(self, url: str):
+        """
+        Time one attempt. The caller stores the response in the yielded dict
+        so its status and body size are recorded when the block exits.
+        """
+        sample = {'response': None}
+        start = time.perf_counter()
+        try:
+            yield sample
+        finally:
+            stats = self._stats(url)
+            stats['latencies'].append(time.perf_counter() - start)
+            response = sample['response']
+            if response is None:
+                stats['errors'] += 1
+            else:
+                stats['status'][response.status] = stats['status'].get(response.status, 0) + 1
+                stats['bytes'] += response.content.total_bytes
+
+    def record_retry(self, url: str) -> None:
+        self._stats(url)['retries'] += 1
+
+    def record_wait(self, url: str, seconds: float) -> None:
+        self._stats(url)['wait_seconds'] += seconds
+
+    @staticmethod
+    def _percentile(values: List[float], q: float) -> float:
+        return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        elapsed = time.monotonic() - self.started
+        endpoints = {}
+        for name, stats in sorted(self.endpoints.items()):
+            latencies = sorted(stats['latencies'])
+            endpoints[name] = {
+                'requests': len(latencies),
+                'status_codes': {str(code): n for code, n in sorted(stats['status'].items())},
+                'errors': stats['errors'],
+                'retries': stats['retries'],
+                'throttled': stats['status'].get(429, 0),
+                'wait_seconds': round(stats['wait_seconds'], 3),
+                'bytes': stats['bytes'],
+                'latency_seconds': {
+                    'p50': round(self._percentile(latencies, 0.50), 4),
+                    'p90': round(self._percentile(latencies, 0.90), 4),
+                    'p99': round(self._percentile(latencies, 0.99), 4),
+                    'max': round(latencies[-1], 4) if latencies else 0.0,
+                    'mean': round(sum(latencies) / len(latencies), 4) if latencies else 0.0,
+                },
+            }
+        return {
+            'run_seconds': round(elapsed, 3),
+            'slots': {
+                'max_concurrency': governor.max_concurrency,
+                'busy_seconds': round(governor.busy_seconds, 3),
+                'utilization': round(governor.busy_seconds / (elapsed * governor.max_concurrency), 4) if elapsed else 0.0,
+                'throttled': governor.throttled,
+                'waited_seconds': round(governor.waited_seconds, 3),
+                'concurrency': governor.concurrency.snapshot(),
+            },
+            'endpoints': endpoints,
+        }
+
+    def to_prometheus(self) -> str:
+        snapshot = self.snapshot()
+        lines = [
+            '# HELP moysklad_request_duration_seconds Latency of each request attempt.',
+            '# TYPE moysklad_request_duration_seconds histogram',
+        ]
+        for name, stats in sorted(self.endpoints.items()):
+            latencies = stats['latencies']
+            for bound in self.buckets:
+                count = sum(1 for value in latencies if value <= bound)
+                lines.append(f'moysklad_request_duration_seconds_bucket{{endpoint="{name}",le="{bound}"}} {count}')
+            lines.append(f'moysklad_request_duration_seconds_bucket{{endpoint="{name}",le="+Inf"}} {len(latencies)}')
+            lines.append(f'moysklad_request_duration_seconds_sum{{endpoint="{name}"}} {sum(latencies):.6f}')
+            lines.append(f'moysklad_request_duration_seconds_count{{endpoint="{name}"}} {len(latencies)}')
+
+        counters = [
+            ('moysklad_request_errors_total', 'Attempts that failed without a response.', 'errors'),
+            ('moysklad_request_retries_total', 'Retried attempts.', 'retries'),
+            ('moysklad_governor_wait_seconds_total', 'Time requests were held back by the governor.', 'wait_seconds'),
+            ('moysklad_response_bytes_total', 'Response body bytes received.', 'bytes'),
+        ]
+        lines += [
+            '# HELP moysklad_responses_total Responses by status code.',
+            '# TYPE moysklad_responses_total counter',
+        ]
+        for name, stats in snapshot['endpoints'].items():
+            for code, n in stats['status_codes'].items():
+                lines.append(f'moysklad_responses_total{{endpoint="{name}",code="{code}"}} {n}')
+        for metric, help_text, key in counters:
+            lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} counter']
+            for name, stats in snapshot['endpoints'].items():
+                lines.append(f'{metric}{{endpoint="{name}"}} {stats[key]}')
+
+        slots = snapshot['slots']
+        concurrency = slots['concurrency']
+        lines += [
+            '# HELP moysklad_concurrency_limit Concurrency limit at the end of the run.',
+            '# TYPE moysklad_concurrency_limit gauge',
+            f'moysklad_concurrency_limit {concurrency["limit"]}',
+            '# HELP moysklad_concurrency_limit_mean Time-weighted mean concurrency limit over the run.',
+            '# TYPE moysklad_concurrency_limit_mean gauge',
+            f'moysklad_concurrency_limit_mean {concurrency["mean_limit"]}',
+            '# HELP moysklad_concurrency_increases_total Additive increases of the concurrency limit.',
+            '# TYPE moysklad_concurrency_increases_total counter',
+            f'moysklad_concurrency_increases_total {concurrency["increases"]}',
+            '# HELP moysklad_concurrency_decreases_total Multiplicative decreases of the concurrency limit by cause.',
+            '# TYPE moysklad_concurrency_decreases_total counter',
+        ]
+        for reason, n in concurrency['decreases'].items():
+            lines.append(f'moysklad_concurrency_decreases_total{{reason="{reason}"}} {n}')
+        lines += [
+            '# HELP moysklad_slot_busy_seconds_total Slot-seconds with a request in flight.',
+            '# TYPE moysklad_slot_busy_seconds_total counter',
+            f'moysklad_slot_busy_seconds_total {slots["busy_seconds"]}',
+            '# HELP moysklad_slot_utilization Share of slot capacity used over the run.',
+            '# TYPE moysklad_slot_utilization gauge',
+            f'moysklad_slot_utilization {slots["utilization"]}',
+            '# HELP moysklad_run_duration_seconds Wall time of the run.',
+            '# TYPE moysklad_run_duration_seconds gauge',
+            f'moysklad_run_duration_seconds {snapshot["run_seconds"]}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def export(self, json_path: str = METRICS_JSON, prom_path: str = METRICS_PROM) -> None:
+        with open(json_path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+        with open(prom_path, 'w') as f:
+            f.write(self.to_prometheus())
+        logging.info(f"Request metrics written to {json_path} and {prom_path}")
+
+metrics = RequestMetrics()
+
+# -------------------------------------------------------------------------------
+# Per-stage wall time, CPU time and peak memory of the pipeline in main()
+# -------------------------------------------------------------------------------
+class StageProfiler:
+    """
+    start() ends the running stage and begins the next one, stop() ends the
+    last. CPU time covers all threads of the process; RSS is sampled on a
+    background thread every `interval` seconds while a stage runs.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self._process = psutil.Process()
+        self._name: Optional[str] = None
+        self._wall = self._cpu = 0.0
+        self._peak = 0
+        self._done = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+
+    def _sample(self) -> None:
+        while not self._done.wait(self.interval):
+            self._peak = max(self._peak, self._process.memory_info().rss)
+
+    def start(self, name: str) -> None:
+        self._finish()
+        self._name = name
+        self._peak = self._process.memory_info().rss
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        if self._sampler is None:
+            self._done.clear()
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+
+    def stop(self) -> None:
+        self._finish()
+        if self._sampler is not None:
+            self._done.set()
+            self._sampler.join()
+            self._sampler = None
+
+    def _finish(self) -> None:
+        if self._name is None:
+            return
+        peak = max(self._peak, self._process.memory_info().rss)
+        self.stages[self._name] = {
+            'wall_seconds': round(time.perf_counter() - self._wall, 4),
+            'cpu_seconds': round(time.process_time() - self._cpu, 4),
+            'peak_rss_mb': round(peak / 2**20, 1),
+        }
+        self._name = None
+
+    def summary(self) -> str:
+        return "; ".join(
+            f"{name}: {s['wall_seconds']:.2f}s wall, {s['cpu_seconds']:.2f}s CPU, {s['peak_rss_mb']:.0f} MB"
+            for name, s in self.stages.items()
+        )
+
+profiler = StageProfiler()
+
+# -------------------------------------------------------------------------------
+# JSON decoder for response bodies
+# -------------------------------------------------------------------------------
+def json_decoders() -> Dict[str, Callable[[bytes], Any]]:
+    """Decoders installed here, fastest first. Each takes the raw body bytes."""
+    decoders = {}
+    if orjson is not None:
+        decoders['orjson'] = orjson.loads
+    if msgspec is not None:
+        decoders['msgspec'] = msgspec.json.Decoder().decode
+    # The standard library decodes bytes to str first; the others parse the bytes directly
+    decoders['json'] = json.loads
+    return decoders
+
+def select_json_decoder(name: str = JSON_DECODER) -> Tuple[str, Callable[[bytes], Any]]:
+    decoders = json_decoders()
+    if name == 'auto':
+        return next(iter(decoders.items()))
+    if name not in decoders:
+        logging.warning(f"JSON decoder {name!r} is not installed; using {next(iter(decoders))}")
+        return next(iter(decoders.items()))
+    return name, decoders[name]
+
+json_decoder_name, json_loads = select_json_decoder()
+JSON_DECODE_ERRORS = (ValueError, msgspec.DecodeError) if msgspec is not None else (ValueError,)
+
+async def read_json(response: aiohttp.ClientResponse) -> Any:
+    """
+    Decode a response body with json_loads. Used instead of response.json(),
+    which always builds a str from the body before handing it to a decoder.
+    """
+    body = await response.read()
+    try:
+        return json_loads(body) if body else None
+    except JSON_DECODE_ERRORS as e:
+        raise aiohttp.ClientPayloadError(f"Malformed JSON response: {e}") from e
+
+# -------------------------------------------------------------------------------
+# Output columns: OUTPUT_COLUMNS compiled into extractor functions
+# -------------------------------------------------------------------------------
+def kopecks(value: float) -> float:
+    """MoySklad prices are in kopecks."""
+    return value / 100
+
+def barcodes(barcodes_list: List[Dict[str, Any]]) -> str:
+    """All ean13 barcodes joined with commas; without any, the keys of the first barcode."""
+    ean13_codes = [barcode.get("ean13") for barcode in barcodes_list if "ean13" in barcode]
+    if ean13_codes:
+        return ",".join(ean13_codes)
+    if barcodes_list:
+        return ",".join(list(barcodes_list[0].keys()))
+    return ""
+
+# Transforms OUTPUT_COLUMNS can name: function and the typecode of its
+# column buffer (None: a list)
+TRANSFORMS: Dict[str, Tuple[Callable[[Any], Any], Optional[str]]] = {
+    'kopecks': (kopecks, 'd'),
+    'barcodes': (barcodes, None),
+}
+BUFFER_TYPECODES = {float: 'd', int: 'q'}
+
+def intern_str(value: Any) -> Any:
+    """sys.intern for strings, anything else as is."""
+    return sys.intern(value) if value.__class__ is str else value
+
+LOOKUP_ERRORS = (KeyError, IndexError, TypeError, AttributeError)
+
+class ColumnSpec:
+    """One OUTPUT_COLUMNS entry with its path split into key tuples."""
+
+    def __init__(self, name: str, path: Optional[str], transform: Any = None, default: Any = None,
+                 intern: bool = False):
+        self.name = name
+        self.path = path
+        self.default = default
+        self.intern = intern  # values go through intern_str
+        if isinstance(transform, str):
+            if transform not in TRANSFORMS:
+                raise ValueError(f"Column {name!r}: unknown transform {transform!r}")
+            self.transform, self.typecode = TRANSFORMS[transform]
+        else:
+            self.transform, self.typecode = transform, BUFFER_TYPECODES.get(transform)
+        # keys [list_key.path=match] rest, or just keys
+        self.keys: Tuple[Any, ...] = ()
+        self.list_key: Optional[Tuple[Any, ...]] = None
+        self.match: Optional[str] = None
+        self.rest: Tuple[Any, ...] = ()
+        if path is not None:
+            m = re.fullmatch(r'([^\[\]]*?)(?:\[([^=\[\]]+)=([^\[\]]*)\](?:\.([^\[\]]+))?)?', path)
+            if m is None or not m.group(1):
+                raise ValueError(f"Column {name!r}: bad path {path!r}")
+            self.keys = split_keys(m.group(1))
+            if m.group(2) is not None:
+                self.list_key, self.match = split_keys(m.group(2)), m.group(3)
+                self.rest = split_keys(m.group(4) or "")
+
+    @property
+    def constant(self) -> bool:
+        return self.path is None
+
+    def fields(self) -> Dict[str, Any]:
+        """The projection (see project_fields) that keeps what this column reads."""
+        inner: Optional[Dict[str, Any]] = None
+        if self.list_key is not None:
+            inner = merge_fields(keys_to_fields(self.list_key, None), keys_to_fields(self.rest, None))
+        return keys_to_fields(self.keys, inner)
+
+def split_keys(path: str) -> Tuple[Any, ...]:
+    return tuple(int(key) if key.isdigit() else key for key in path.split('.')) if path else ()
+
+def keys_to_fields(keys: Tuple[Any, ...], leaf: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    # List indexes drop out: a projection applies to every element of a list
+    for key in reversed(keys):
+        if isinstance(key, str):
+            leaf = {key: leaf}
+    return leaf
+
+def merge_fields(a: Optional[Dict[str, Any]], b: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    if a is None or b is None:
+        return None
+    merged = dict(a)
+    for key, sub in b.items():
+        merged[key] = merge_fields(merged[key], sub) if key in merged else sub
+    return merged
+
+def lookup_lines(target: str, source: str, keys: Tuple[Any, ...], indent: int = 4,
+                 source_is_dict: bool = False) -> List[str]:
+    """Source lines setting `target` to source[k0][k1]..., None where any step is missing."""
+    pad = ' ' * indent
+    lines = []
+    if source_is_dict and isinstance(keys[0], str):
+        # A row is always a dict: .get() instead of catching KeyError
+        lines.append(f"{pad}{target} = {source}.get({keys[0]!r})")
+        keys, source = keys[1:], target
+        if not keys:
+            return lines
+        lines.append(f"{pad}if {target} is not None:")
+        pad += '    '
+    subscripts = ''.join(f'[{key!r}]' for key in keys)
+    lines += [
+        f"{pad}try:",
+        f"{pad}    {target} = {source}{subscripts}",
+        f"{pad}except LOOKUP_ERRORS:",
+        f"{pad}    {target} = None",
+    ]
+    return lines
+
+def compile_columns(
+    columns: List[ColumnSpec],
+    appends: Optional[List[Callable[[Any], Any]]] = None
+) -> Callable[[Dict[str, Any]], Any]:
+    """
+    Compile the non-constant `columns` into one function of an assortment
+    row. Its source is generated with every key tuple, default and transform
+    written in, so a row runs straight-line lookups and never loops over
+    the spec. Columns matching elements of the same list by the same key
+    (the price types in salePrices) share one walk over the list.
+
+    Returns row -> tuple of the column values or, with `appends` (one per
+    non-constant column), a function that passes each value to its append
+    once all values of the row are extracted, so a row that raises appends
+    nothing.
+    """
+    columns = [column for column in columns if not column.constant]
+    namespace: Dict[str, Any] = {'LOOKUP_ERRORS': LOOKUP_ERRORS, 'intern': intern_str}
+    lines = ["def extract(row):"]
+    groups: Dict[Tuple[Any, ...], int] = {}
+    for i, column in enumerate(columns):
+        namespace[f'd{i}'] = column.default
+        namespace[f't{i}'] = column.transform
+        if column.list_key is None:
+            lines += lookup_lines('v', 'row', column.keys, source_is_dict=True)
+        else:
+            group = (column.keys, column.list_key)
+            if group not in groups:
+                g = groups[group] = len(groups)
+                namespace[f'w{g}'] = frozenset(c.match for c in columns if (c.keys, c.list_key) == group)
+                lines += lookup_lines('elements', 'row', column.keys, source_is_dict=True)
+                lines += [
+                    f"    found{g} = {{}}",
+                    "    if type(elements) is list:",
+                    "        for element in elements:",
+                ]
+                lines += lookup_lines('key', 'element', column.list_key, indent=12)
+                lines += [
+                    f"            if key in w{g} and key not in found{g}:",
+                    f"                found{g}[key] = element",
+                ]
+            lines.append(f"    v = found{groups[group]}.get({column.match!r})")
+            if column.rest:
+                lines.append("    if v is not None:")
+                lines += lookup_lines('v', 'v', column.rest, indent=8)
+        if column.transform is not None:
+            lines.append("    if v is not None:")
+            lines.append(f"        v = t{i}(v)")
+        if column.intern:
+            lines.append(f"    c{i} = d{i} if v is None else intern(v)")
+        else:
+            lines.append(f"    c{i} = d{i} if v is None else v")
+    if appends is None:
+        lines.append(f"    return ({''.join(f'c{i}, ' for i in range(len(columns)))})")
+    else:
+        if len(appends) != len(columns):
+            raise ValueError(f"{len(appends)} appends for {len(columns)} columns")
+        for i, append in enumerate(appends):
+            namespace[f'a{i}'] = append
+            lines.append(f"    a{i}(c{i})")
+    exec("\n".join(lines), namespace)
+    return namespace['extract']
+
+def columns_fields(columns: List[ColumnSpec], fields: Dict[str, Any]) -> Dict[str, Any]:
+    """`fields` plus the projection of every column in `columns`."""
+    for column in columns:
+        if not column.constant:
+            fields = merge_fields(fields, column.fields())
+    return fields
+
+OUTPUT_SPEC = [ColumnSpec(*column, intern=column[0] in INTERNED_COLUMNS) for column in OUTPUT_COLUMNS]
+
+# -------------------------------------------------------------------------------
+# Streaming page decoder that keeps only the fields the pipeline reads
+# -------------------------------------------------------------------------------
+# Projection spec: None keeps the whole value, a dict keeps only those keys
+# (applied to every element when the value is a list). The pipeline's own
+# fields plus whatever OUTPUT_COLUMNS read.
+ROW_FIELDS = {
+    'id': None,
+    'pathName': None,
+    'variantsCount': None,
+    'meta': {'type': None},
+    'product': {'meta': {'href': None}},
+}
+ASSORTMENT_FIELDS = columns_fields(OUTPUT_SPEC, ROW_FIELDS)
+DECODE_CHUNK_SIZE = 64 * 1024
+
+def project_fields(value: Any, spec: Optional[Dict[str, Any]]) -> Any:
+    if spec is None:
+        return value
+    if isinstance(value, list):
+        return [project_fields(item, spec) for item in value]
+    if isinstance(value, dict):
+        return {key: project_fields(value[key], sub) for key, sub in spec.items() if key in value}
+    return value
+
+async def decode_page(chunks, fields: Dict[str, Any] = ASSORTMENT_FIELDS) -> Dict[str, Any]:
+    """
+    Decode an entity list page from an async iterable of byte chunks,
+    keeping only `fields` of every row and meta.size.
+
+    Rows are parsed one at a time and projected immediately, so the full
+    page never exists in memory. Requires ijson.
+    """
+    rows: List[Dict[str, Any]] = []
+    row_sink = ijson.sendable_list()
+    size_sink = ijson.sendable_list()
+    rows_parser = ijson.items_coro(row_sink, 'rows.item', use_float=True)
+    # meta precedes rows in MoySklad responses, so this parser stops early
+    size_parser = ijson.items_coro(size_sink, 'meta.size')
+    try:
+        async for chunk in chunks:
+            if not size_sink:
+                size_parser.send(chunk)
+            rows_parser.send(chunk)
+            if row_sink:
+                rows.extend(project_fields(row, fields) for row in row_sink)
+                del row_sink[:]
+        rows_parser.close()
+    except ijson.JSONError as e:
+        raise aiohttp.ClientPayloadError(f"Malformed JSON page: {e}") from e
+    rows.extend(project_fields(row, fields) for row in row_sink)
+    meta = {'size': size_sink[0]} if size_sink else {}
+    return {'meta': meta, 'rows': rows}
+
+async def read_page(response: aiohttp.ClientResponse, fields: Dict[str, Any] = ASSORTMENT_FIELDS) -> Dict[str, Any]:
+    """
+    Read a list page keeping only `fields` of every row. With STREAM_PAGES
+    (and ijson installed) the page is decoded by decode_page() as it arrives.
+    """
+    if STREAM_PAGES and ijson is not None:
+        return await decode_page(response.content.iter_chunked(DECODE_CHUNK_SIZE), fields)
+    data = await read_json(response)
+    if not isinstance(data, dict):
+        raise aiohttp.ClientPayloadError(f"Malformed JSON page: expected an object, got {type(data).__name__}")
+    data['rows'] = [project_fields(row, fields) for row in data.get('rows', [])]
+    return data
 
 # -------------------------------------------------------------------------------
 # Async function to fetch data with retries and error handling
@@ -249,127 +981,570 @@ INCLUDED_PRICE_TYPES = [
 async def fetch(
     session: ClientSession,
     url: str,
-    retries: int = 5
-) -> Optional[Dict[str, Any]]:
-    global auth
-    login_attempts = 0
-    for attempt in range(retries):
+    retries: int = 5,
+    fields: Optional[Dict[str, Any]] = None,
+    raw: bool = False,
+    shared: bool = False
+) -> Optional[Any]:
+    """
+    GET `url` and return the decoded JSON. With `fields` the response is
+    treated as a list page and decoded through read_page(); with `raw` the
+    body is returned undecoded, as bytes. With `shared` an identical request
+    already in flight is shared instead of sent again - for lookups by id,
+    which can repeat; a paginated walk never requests a URL twice.
+    """
+    if not shared:
+        return await fetch_from_api(session, url, retries, fields, raw)
+    return await single_flight.do(
+        (url, id(fields), raw),
+        lambda: fetch_from_api(session, url, retries, fields, raw)
+    )
+
+async def fetch_from_api(
+    session: ClientSession,
+    url: str,
+    retries: int = 5,
+    fields: Optional[Dict[str, Any]] = None,
+    raw: bool = False
+) -> Optional[Any]:
+    resilience.requests += 1
+    attempt = 0             # failed attempts: 5xx, timeouts, connection errors
+    auth_retries = 0
+    throttled_retries = 0
+    retrying = None         # why the previous attempt is repeated: 'failure' or 'throttled'
+    while attempt < retries:
+        if retrying is not None:
+            # Only failures draw on the run-wide budget; a 429 says the API is
+            # up but busy, and the governor already paces the retry
+            if retrying == 'failure' and not resilience.try_retry():
+                logging.error(f"❌ Retry budget exhausted, giving up on {url}")
+                return None
+            metrics.record_retry(url)
+        unauthorized = throttled = False
+        sent_at = None
         try:
-            async with session.get(url, auth=auth) as response:
-                if response.status == 401:
-                    logging.error(f"❌ Unauthorized access (401) to {url}. Requesting new credentials.")
-                    if login_attempts >= MAX_LOGIN_ATTEMPTS:
-                        print("❌ Too many incorrect login attempts. Exiting...")
-                        exit(1)
-                    new_username, new_password = get_credentials()
-                    auth = BasicAuth(new_username, new_password)
-                    login_attempts += 1
-                    logging.info("🔄 Retrying request with new credentials...")
-                    continue
-                response.raise_for_status()
-                return await response.json()
+            queued_at = time.perf_counter()
+            async with governor:
+                metrics.record_wait(url, time.perf_counter() - queued_at)
+                # Checked after taking a slot so nothing queued behind the
+                # governor slips out while the circuit is open
+                await resilience.before_request()
+                # Waits here while the auth gate is closed for a refresh
+                headers = await auth.headers(session) if auth else None
+                token = auth.token if auth else None
+                sent_at = time.monotonic()
+                with metrics.track(url) as sample:
+                    async with session.get(url, headers=headers) as response:
+                        sample['response'] = response
+                        governor.update(response.status, response.headers)
+                        if response.status == 429:
+                            governor.concurrency.record_congestion('throttled', sent_at)
+                        elif response.status < 500:
+                            governor.concurrency.record_latency(
+                                metrics.endpoint(url), time.monotonic() - sent_at, sent_at, governor.saturated
+                            )
+                        if response.status < 500:
+                            resilience.record_success()
+                        if response.status == 401 and auth is not None:
+                            unauthorized = True
+                        elif response.status == 429:
+                            # The governor has already paused dispatch for the requested interval
+                            logging.warning(f"⚠️ Attempt {attempt + 1} throttled (429) for {url}")
+                            throttled = True
+                        elif response.status < 500:
+                            response.raise_for_status()
+                            if raw:
+                                return await response.read()
+                            if fields is not None:
+                                return await read_page(response, fields)
+                            return await read_json(response)
+                        else:
+                            resilience.record_failure()
+                            logging.warning(f"⚠️ Attempt {attempt + 1} failed with {response.status} for {url}")
         except aiohttp.ClientResponseError as e:
             logging.error(f"🚨 Request failed ({e.status}) for {url}: {e}")
             return None
         except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            resilience.record_failure()
+            if sent_at is not None:
+                reason = 'timeout' if isinstance(e, asyncio.TimeoutError) else 'error'
+                governor.concurrency.record_congestion(reason, sent_at)
             logging.warning(f"⚠️ Attempt {attempt + 1} failed: {e}")
-            if attempt < retries - 1:
-                await asyncio.sleep(1)
-            else:
-                logging.error(f"❌ All {retries} attempts failed for {url}")
+        if unauthorized:
+            # Refreshed outside the governor slot; a rejected token does not
+            # count as a failed attempt, so a password change drops no pages
+            auth_retries += 1
+            if auth_retries <= MAX_LOGIN_ATTEMPTS and await auth.refresh(session, token):
+                logging.info(f"🔄 Retrying {url} with new credentials...")
+                continue
+            logging.error(f"❌ Unauthorized access (401) to {url}, giving up.")
+            return None
+        if throttled:
+            throttled_retries += 1
+            if throttled_retries > MAX_THROTTLED_RETRIES:
+                logging.error(f"❌ Still throttled (429) after {MAX_THROTTLED_RETRIES} retries, giving up on {url}")
                 return None
+            retrying = 'throttled'
+            continue
+        attempt += 1
+        retrying = 'failure'
+        if attempt < retries:
+            await resilience.backoff(attempt - 1)
+    logging.error(f"❌ All {retries} attempts failed for {url}")
     return None
 
 # -------------------------------------------------------------------------------
-# Fetch product details and allow easy extension for additional API data
+# Variants: the parent product of a variant row
+# -------------------------------------------------------------------------------
+def variant_parent_id(product: Dict[str, Any]) -> str:
+    return product.get('product', {}).get('meta', {}).get('href', '').split('/')[-1]
+
+# -------------------------------------------------------------------------------
+# Batch transform: a whole page of rows in one synchronous pass
+# -------------------------------------------------------------------------------
+def transform_page(
+    rows: List[Dict[str, Any]],
+    index: Optional['PathIndex'] = None,
+    columns: Optional['ProductColumns'] = None,
+    page_offset: int = 0
+) -> 'ProductColumns':
+    """
+    Append the rows of the page at `page_offset` to `columns` (a new
+    ProductColumns if none) in one pass, adding the path of every product
+    to `index` on the way. Products with variants and variants are
+    exported, products without variants are not. A row that fails is
+    logged and skipped.
+    """
+    if columns is None:
+        columns = ProductColumns()
+    for product in rows:
+        try:
+            if product.get('meta', {}).get('type') == 'variant':
+                columns.append(product, page_offset)
+                continue
+            if index is not None:
+                index.add(product['id'], product.get('pathName', ""))
+            if product.get('variantsCount', -1) > 0:
+                columns.append(product, page_offset)
+        except Exception as ex:
+            logging.error(f"Error transforming row {product.get('id')}: {ex}")
+    return columns
+
+# -------------------------------------------------------------------------------
+# Columnar output table, filled by the transform stage
+# -------------------------------------------------------------------------------
+class ProductColumns:
+    """
+    The exported rows, one buffer per column of `spec` (OUTPUT_SPEC):
+    array('d') / array('q') for float and int columns, lists for the rest,
+    nothing for constant columns. append() runs the function compiled from
+    the spec (compile_columns), which appends straight into the buffers, so
+    no dict exists per row, and to_dataframe() hands pandas whole columns.
+    Text of INTERNED_COLUMNS and parent ids is interned: a path shared by
+    thousands of rows is one string, here, in PathIndex and in the DataFrame.
+
+    `path` and `id` are the buffers of the 'Путь' and 'ID' columns, which
+    resolve_variant_paths() needs; `parent_id` is set for variants only.
+
+    Pages arrive in completion order, so every row keeps the offset of its
+    page in `page_offset`; to_dataframe() puts the rows back in catalog
+    order (by page offset, then by position in the page).
+    """
+
+    def __init__(self, spec: List[ColumnSpec] = OUTPUT_SPEC):
+        self.spec = list(spec)
+        self.buffers: Dict[str, Any] = {
+            column.name: array(column.typecode) if column.typecode else []
+            for column in self.spec if not column.constant
+        }
+        self._append_row = compile_columns(self.spec, [buffer.append for buffer in self.buffers.values()])
+        self.parent_id: List[Optional[str]] = []
+        self.page_offset = array('q')
+        self.path: List[str] = self.buffers['Путь']
+        self.id: List[str] = self.buffers['ID']
+
+    def __len__(self) -> int:
+        return len(self.parent_id)
+
+    def append(self, product: Dict[str, Any], page_offset: int = 0) -> None:
+        if product.get('meta', {}).get('type') == 'variant':
+            parent_id = intern_str(variant_parent_id(product))
+        else:
+            parent_id = None
+        self._append_row(product)
+        self.parent_id.append(parent_id)
+        self.page_offset.append(page_offset)
+
+    def take_chunk(self) -> Dict[str, Any]:
+        """
+        The rows so far as plain arrays and lists, which pickle compactly
+        (transform_page_bytes sends them between processes), leaving the
+        table empty.
+        """
+        chunk = {'buffers': {name: buffer[:] for name, buffer in self.buffers.items()},
+                 'parent_id': self.parent_id[:], 'page_offset': self.page_offset[:]}
+        for buffer in self.buffers.values():
+            del buffer[:]
+        del self.parent_id[:]
+        del self.page_offset[:]
+        return chunk
+
+    def extend_chunk(self, chunk: Dict[str, Any]) -> None:
+        """Append the rows of a take_chunk() result from a table with the same spec."""
+        interned = {column.name for column in self.spec if column.intern}
+        for name, values in chunk['buffers'].items():
+            # Strings come out of pickle as new objects: intern them again
+            self.buffers[name].extend(map(intern_str, values) if name in interned else values)
+        self.parent_id.extend(map(intern_str, chunk['parent_id']))
+        self.page_offset.extend(chunk['page_offset'])
+
+    def catalog_order(self) -> Optional[np.ndarray]:
+        """Row indices in catalog order, or None when the rows already are."""
+        offsets = np.frombuffer(self.page_offset, dtype=np.int64)
+        if len(offsets) < 2 or not (offsets[1:] < offsets[:-1]).any():
+            return None
+        # Stable, so rows of one page keep their order
+        return np.argsort(offsets, kind='stable')
+
+    def to_dataframe(self) -> pd.DataFrame:
+        n = len(self)
+        order = self.catalog_order()
+        data = {}
+        for column in self.spec:
+            if column.constant:
+                data[column.name] = np.full(n, column.default, dtype=object)
+                continue
+            buffer = self.buffers[column.name]
+            if column.typecode:
+                values = np.frombuffer(buffer, dtype=np.float64 if column.typecode == 'd' else np.int64)
+                data[column.name] = values.copy() if order is None else values[order]
+            else:
+                data[column.name] = buffer if order is None else [buffer[i] for i in order.tolist()]
+        return pd.DataFrame(data)
+
+# -------------------------------------------------------------------------------
+# Variant paths: id -> pathName index of all products, kept between runs
 # -------------------------------------------------------------------------------
-async def fetch_product_details(
+class PathIndex:
+    """
+    pathName of every product by id. Variants have no path of their own and
+    take their parent's, looked up here once all pages are in, so the
+    result does not depend on page or row order.
+
+    The index is saved to `path` at the end of a run and loaded at the
+    start of the next: paths from the current run replace cached ones, and
+    a parent missing from this run (a failed page) is still found. Only
+    entries seen or used in a run are saved again, so deleted products
+    drop out of the cache. Paths are interned, like the path column.
+    """
+
+    def __init__(self, path: str = PATH_INDEX_FILE):
+        self.path = path
+        self.paths: Dict[str, str] = {}
+        self.cached = 0       # entries loaded from the cache file
+        self.fetched = 0      # parents fetched because no page had them
+        self._current = set() # ids seen or used in this run
+
+    def load(self) -> None:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.paths = {key: intern_str(path) for key, path in json.load(f).items()}
+        except FileNotFoundError:
+            self.paths = {}
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring path index {self.path}: {e}")
+            self.paths = {}
+        self.cached = len(self.paths)
+
+    def save(self) -> None:
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump({key: self.paths[key] for key in self._current}, f, ensure_ascii=False)
+
+    def add(self, product_id: str, path: str) -> None:
+        self.paths[product_id] = intern_str(path)
+        self._current.add(product_id)
+
+    def update(self, paths: Dict[str, str]) -> None:
+        for product_id, path in paths.items():
+            self.add(product_id, path)
+
+    def get(self, product_id: str) -> Optional[str]:
+        path = self.paths.get(product_id)
+        if path is not None:
+            self._current.add(product_id)
+        return path
+
+    def __contains__(self, product_id: str) -> bool:
+        return product_id in self.paths
+
+PARENT_FIELDS = {'id': None, 'pathName': None}
+
+async def fetch_parent_paths(session: ClientSession, parent_ids: List[str], index: PathIndex,
+                             product_url: str, batch_size: int = PARENT_BATCH_SIZE) -> None:
+    """Fetch the paths of products by id, `batch_size` ids per request (filter=id=..;id=..)."""
+    async def fetch_batch(batch: List[str]):
+        ids = ';'.join(f'id={product_id}' for product_id in batch)
+        data = await fetch(session, f"{product_url}?filter={ids}&limit={len(batch)}",
+                           fields=PARENT_FIELDS, shared=True)
+        for row in (data or {}).get('rows', []):
+            index.add(row['id'], row.get('pathName', ""))
+            index.fetched += 1
+
+    batches = [parent_ids[i:i + batch_size] for i in range(0, len(parent_ids), batch_size)]
+    await asyncio.gather(*(fetch_batch(batch) for batch in batches))
+
+async def resolve_variant_paths(
     session: ClientSession,
-    product: Dict[str, Any],
-    base_product_paths: Dict[str, str]
-) -> Optional[Dict[str, Any]]:
-    """
-    Fetch detailed product information.
-    
-    # NOTE: To add more details from the API in the future,
-    # you can extend the returned dictionary below by extracting additional
-    # fields from the 'product' dict.
-    """
-    path_name = product.get('pathName', "")
-
-    # If it's a base product, record its path
-    if product.get('variantsCount', -1) > 0:
-        base_product_paths[product['id']] = path_name
-
-    # If it's a variant, try to get the parent product's path
-    if product.get('meta', {}).get('type') == 'variant':
-        parent_id = product.get('product', {}).get('meta', {}).get('href', '').split('/')[-1]
-        path_name = base_product_paths.get(parent_id, "")
-
-    # Extract category from characteristics; extend here if needed
-    category_value = "base"
-    characteristics: List[Dict[str, Any]] = product.get('characteristics', [])
-    for char in characteristics:
-        category_value = str(char.get('value', 'base'))
-        break
-
-    # Filter salePrices to include only selected types
-    sale_prices = product.get('salePrices', [])
-    prices = {
-        p.get('priceType', {}).get('name', 'Unknown'): (p.get('value', 0) / 100)
-        for p in sale_prices
-        if p.get('priceType', {}).get('name') in INCLUDED_PRICE_TYPES
-    }
-
-    # ---------------------------
-    # Extract barcode information:
-    # Look for 'ean13' barcodes; if none, output keys from the first barcode dict.
-    barcodes_list = product.get("barcodes", [])
-    ean13_codes = [barcode.get("ean13") for barcode in barcodes_list if "ean13" in barcode]
-    if ean13_codes:
-        barcode_value = ",".join(ean13_codes)
-    elif barcodes_list:
-        # If no 'ean13' found but barcodes exist, output the key names from the first dictionary.
-        barcode_value = ",".join(list(barcodes_list[0].keys()))
-    else:
-        barcode_value = ""
-    # ---------------------------
-
-    return {
-        'name': product.get('name'),
-        'code': product.get('code'),
-        'path': path_name,
-        'stock': product.get('stock', 0),
-        'days': product.get('stockDays', 0),
-        'category': category_value,
-        'prices': prices,
-        'id': product.get('id'),
-        'ean13': barcode_value  # New field with barcode information
-    }
-
-# -------------------------------------------------------------------------------
-# Fetch all products using pagination with a progress bar
-# -------------------------------------------------------------------------------
-async def fetch_all_products(session: ClientSession, base_url: str, limit: int = PAGE_SIZE):
-    offset = 0
-    all_items = []
-    base_product_paths = {}
+    columns: ProductColumns,
+    index: PathIndex,
+    product_url: str
+) -> List[int]:
+    """
+    Give every variant its parent's path in one pass over the parent_id
+    column. Parents in neither the run nor the cache are fetched in batches
+    first. Returns the rows whose parent could not be found.
+    """
+    variants = [row for row, parent_id in enumerate(columns.parent_id) if parent_id]
+    missing = sorted({columns.parent_id[row] for row in variants if columns.parent_id[row] not in index})
+    if missing:
+        logging.info(f"Fetching {len(missing)} parent products missing from the assortment pages...")
+        await fetch_parent_paths(session, missing, index, product_url)
+
+    unresolved = []
+    for row in variants:
+        path = index.get(columns.parent_id[row])
+        if path is None:
+            unresolved.append(row)
+        else:
+            columns.path[row] = path
+
+    logging.info(
+        f"Variant paths: {len(variants) - len(unresolved)} of {len(variants)} resolved, "
+        f"{len(missing)} parents in neither the pages nor the cache ({index.fetched} fetched), "
+        f"{index.cached} cached entries"
+    )
+    if unresolved:
+        parents = sorted({columns.parent_id[row] for row in unresolved})
+        first = unresolved[0]
+        logging.warning(
+            f"Unresolved variant paths: {len(unresolved)} variants of {len(parents)} unknown parents, "
+            f"e.g. variant {columns.id[first]} (parent {columns.parent_id[first]}); parents: {parents[:20]}"
+        )
+        print(color.RED + f"Не удалось определить путь для {len(unresolved)} модификаций "
+                          f"(родительские товары не найдены: {len(parents)})" + color.END)
+    return unresolved
+
+# -------------------------------------------------------------------------------
+# Process-pool transform: raw pages decoded and transformed in worker processes
+# -------------------------------------------------------------------------------
+_worker_columns: Optional[ProductColumns] = None  # one per worker process, reused for every page
+
+def transform_page_bytes(body: bytes, page_offset: int = 0) -> Tuple[int, Dict[str, Any], Dict[str, str]]:
+    """
+    Worker process: decode one raw assortment page and transform it.
+    Returns the number of rows, the exported rows as a ProductColumns chunk
+    (see take_chunk) and the path of every product on the page.
+    """
+    global _worker_columns
+    if _worker_columns is None:
+        _worker_columns = ProductColumns()
+    rows = json_loads(body).get('rows', [])
+    index = PathIndex(path=None)
+    transform_page(rows, index, _worker_columns, page_offset)
+    return len(rows), _worker_columns.take_chunk(), index.paths
+
+def transform_pool(processes: Optional[int] = TRANSFORM_PROCESSES) -> Optional[ProcessPoolExecutor]:
+    """
+    Worker processes for transform_page_bytes, or None when `processes` is
+    0. Workers are spawned, not forked, on every platform: a fork of a
+    process running an event loop and threads is not safe, and Windows
+    cannot fork at all.
+    """
+    if processes == 0:
+        return None
+    os.environ[TRANSFORM_WORKER_ENV] = "1"  # inherited by the workers, see Logging Setup
+    return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+
+# -------------------------------------------------------------------------------
+# Streaming pipeline: assortment pages are transformed as they arrive
+# -------------------------------------------------------------------------------
+async def fetch_product_pages(
+    session: ClientSession,
+    base_url: str,
+    queue: asyncio.Queue,
+    limit: int = PAGE_SIZE,
+    parallel: bool = PARALLEL_PAGES,
+    raw: bool = False
+) -> List[int]:
+    """
+    Producer: fetch every assortment page and put (offset, rows) on `queue`,
+    then None once all pages are in. Returns the offsets that failed. With
+    `raw` (parallel mode only) pages after the first are put undecoded, as
+    (offset, bytes), for the process pool; the first is decoded for meta.size.
+
+    In parallel mode the first page is fetched alone to read meta.size, then
+    one worker per possible governor slot takes the remaining offsets one by
+    one. A worker with a page waits on a full queue before fetching the
+    next, so with a bounded queue at most (workers + queue size) pages are
+    held at any time, however large the catalog. A failed page is logged and
+    reported but does not stop the other pages.
+    """
+    failed_offsets: List[int] = []
     with tqdm(desc="Fetching Products (batches)", unit="batch", leave=False) as pbar:
-        while True:
-            url = f"{base_url}?limit={limit}&offset={offset}"
-            logging.info(f"Fetching page offset={offset} ...")
-            data = await fetch(session, url)
+        try:
+            if parallel:
+                await _fetch_pages_parallel(session, base_url, queue, limit, failed_offsets, pbar, raw)
+            else:
+                await _fetch_pages_sequential(session, base_url, queue, limit, 0, pbar)
+        finally:
+            await queue.put(None)
+
+    if failed_offsets:
+        failed_offsets.sort()
+        logging.error(f"Failed page offsets: {failed_offsets}")
+        print(color.RED + f"Не удалось загрузить страницы с offset: {failed_offsets}" + color.END)
+    return failed_offsets
+
+async def _fetch_pages_parallel(session, base_url, queue, limit, failed_offsets, pbar, raw=False):
+    logging.info("Fetching page offset=0 ...")
+    first = await fetch(session, f"{base_url}?limit={limit}&offset=0", fields=ASSORTMENT_FIELDS)
+    if not first:
+        logging.warning("No data returned for the first page, stopping pagination.")
+        return
+    total = first.get('meta', {}).get('size')
+    await queue.put((0, first.get('rows', [])))
+    pbar.update(1)
+    if total is None:
+        # No size in meta: walk the remaining pages one by one
+        logging.warning("meta.size missing in response; falling back to sequential pagination.")
+        await _fetch_pages_sequential(session, base_url, queue, limit, limit, pbar)
+        return
+
+    pbar.total = max(1, -(-total // limit))
+    offsets = iter(range(limit, total, limit))
+
+    async def worker():
+        # The offsets iterator is shared, so every offset goes to exactly one worker
+        for page_offset in offsets:
+            logging.info(f"Fetching page offset={page_offset} ...")
+            url = f"{base_url}?limit={limit}&offset={page_offset}"
+            data = await (fetch(session, url, raw=True) if raw else fetch(session, url, fields=ASSORTMENT_FIELDS))
             if not data:
-                logging.warning("No data returned, stopping pagination.")
-                break
-            rows = data.get('rows', [])
-            if not rows:
-                logging.info("No more rows; pagination complete.")
-                break
-            all_items.extend(rows)
-            offset += limit
+                failed_offsets.append(page_offset)
+                logging.error(f"Page offset={page_offset} failed; continuing with remaining pages.")
+            else:
+                await queue.put((page_offset, data if raw else data.get('rows', [])))
+            pbar.set_postfix(limit=governor.concurrency.limit, refresh=False)
             pbar.update(1)
-    return all_items, base_product_paths
+
+    await asyncio.gather(*(worker() for _ in range(governor.concurrency.max_limit)))
+
+async def _fetch_pages_sequential(session, base_url, queue, limit, offset, pbar):
+    while True:
+        url = f"{base_url}?limit={limit}&offset={offset}"
+        logging.info(f"Fetching page offset={offset} ...")
+        data = await fetch(session, url, fields=ASSORTMENT_FIELDS)
+        if not data:
+            logging.warning("No data returned, stopping pagination.")
+            break
+        rows = data.get('rows', [])
+        if not rows:
+            logging.info("No more rows; pagination complete.")
+            break
+        await queue.put((offset, rows))
+        offset += limit
+        pbar.set_postfix(limit=governor.concurrency.limit, refresh=False)
+        pbar.update(1)
+
+async def transform_product_pages(
+    queue: asyncio.Queue,
+    index: Optional[PathIndex] = None,
+    pool: Optional[ProcessPoolExecutor] = None,
+    processes: Optional[int] = TRANSFORM_PROCESSES
+) -> ProductColumns:
+    """
+    Consumer: append every page from `queue` to one ProductColumns with
+    transform_page() as soon as it arrives and drop its raw rows. A page
+    of PAGE_SIZE rows takes a few milliseconds, so it runs inline; a
+    thread would not take the work off the GIL. Variant paths are left to
+    resolve_variant_paths().
+    Rows are tagged with their page offset, so the order pages finish in
+    does not change the order of the sheet (see ProductColumns).
+
+    Raw pages (bytes, see fetch_product_pages) go to `pool`, `processes`
+    worker processes that decode and transform them (transform_page_bytes);
+    only their chunks are merged here, so the event loop does little more
+    than I/O. At most two pages per worker are in flight, the rest wait in
+    the queue and hold back the fetchers.
+    """
+    columns = ProductColumns()
+    loop = asyncio.get_running_loop()
+    in_flight: Dict[asyncio.Future, int] = {}  # future -> page offset
+    max_in_flight = 2 * (processes or os.cpu_count() or 1)
+
+    def merge(future: asyncio.Future) -> None:
+        page_offset = in_flight.pop(future)
+        try:
+            count, chunk, paths = future.result()
+        except Exception as ex:
+            logging.error(f"Page offset={page_offset} could not be transformed: {ex}")
+            print(color.RED + f"Не удалось обработать страницу с offset: {page_offset}" + color.END)
+            return
+        columns.extend_chunk(chunk)
+        if index is not None:
+            index.update(paths)
+        pbar.update(count)
+
+    async def merge_done(wait: bool) -> None:
+        if wait:
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+        else:
+            done = [future for future in in_flight if future.done()]
+        for future in done:
+            merge(future)
+
+    with tqdm(desc=color.YELLOW + "Processing product details" + color.END, unit="item", leave=False) as pbar:
+        while (page := await queue.get()) is not None:
+            page_offset, rows = page
+            if isinstance(rows, bytes):
+                in_flight[loop.run_in_executor(pool, transform_page_bytes, rows, page_offset)] = page_offset
+                del page, rows
+                await merge_done(wait=len(in_flight) >= max_in_flight)
+                continue
+            transform_page(rows, index, columns, page_offset)
+            pbar.update(len(rows))
+            # Raw rows are not needed once the page is transformed
+            del page, rows
+        while in_flight:
+            await merge_done(wait=True)
+    return columns
+
+async def fetch_all_products(
+    session: ClientSession,
+    base_url: str,
+    limit: int = PAGE_SIZE,
+    parallel: bool = PARALLEL_PAGES
+) -> List[Dict[str, Any]]:
+    """
+    Fetch every assortment row into one list, in offset order, for callers
+    that need the whole catalog at once (main() streams the pages instead).
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    producer = asyncio.create_task(fetch_product_pages(session, base_url, queue, limit, parallel))
+    pages: Dict[int, List[Dict[str, Any]]] = {}
+    try:
+        while (page := await queue.get()) is not None:
+            page_offset, rows = page
+            pages[page_offset] = rows
+        await producer
+    finally:
+        producer.cancel()  # no-op once it has finished
+
+    all_items = []
+    for page_offset in sorted(pages):
+        all_items.extend(pages[page_offset])
+    logging.info(f"Fetched {len(all_items)} rows in {len(pages)} pages.")
+    return all_items
 
 # -------------------------------------------------------------------------------
 # Check if the Excel file is open and prompt the user to close it
@@ -402,7 +1577,16 @@ def update_database(data: pd.DataFrame, db_path: str):
 # -------------------------------------------------------------------------------
 # Main asynchronous routine that performs all steps with progress reporting
 # -------------------------------------------------------------------------------
-async def main():
+async def main(cassette: Optional[Cassette] = None):
+    global auth
+    # A replayed run never talks to the API, so it needs no credentials
+    if cassette is None or not cassette.replay:
+        # The password is asked for only when the account's cached token cannot be used
+        auth = TokenAuth(get_login(), credential_source=get_credentials, token_url=TOKEN_URL,
+                         token_file=TOKEN_FILE, max_attempts=MAX_LOGIN_ATTEMPTS)
+
+    logging.info(f"Decoding responses with {json_decoder_name}")
+
     filename = "all_products.xlsx"
     db_path = "all_products.db"
     previous_csv = "last.csv"
@@ -412,74 +1596,72 @@ async def main():
     check_and_prompt_close_excel(filename)
 
     timeout = ClientTimeout(total=120)
-    semaphore = asyncio.Semaphore(MAX_REQUESTS)
 
-    async with ClientSession(timeout=timeout) as session:
+    session = ClientSession(timeout=timeout)
+    if cassette is not None:
+        # --record saves all traffic of the run, --replay serves it back offline
+        session = cassette.wrap(session)
+
+    async with session:
         with tqdm(total=overall_steps, desc="Overall Progress", unit="step") as global_pbar:
-            # Step 1: Fetch all products
+            # Steps 1-3: Fetch the product pages and process each one as it arrives
+            profiler.start("fetch_transform")
             logging.info("Fetching list of all products...")
-            products, base_product_paths = await fetch_all_products(session, base_url)
-            if not products:
+            index = PathIndex()
+            index.load()
+            queue = asyncio.Queue(maxsize=PAGE_QUEUE_SIZE)
+            pool = transform_pool(TRANSFORM_PROCESSES)
+            if pool is not None:
+                logging.info(f"Transforming pages in {TRANSFORM_PROCESSES or os.cpu_count()} worker processes")
+            producer = asyncio.create_task(fetch_product_pages(session, base_url, queue, raw=pool is not None))
+            try:
+                columns = await transform_product_pages(queue, index, pool, TRANSFORM_PROCESSES)
+                await producer
+            finally:
+                producer.cancel()  # no-op once it has finished
+                if pool is not None:
+                    pool.shutdown(wait=False, cancel_futures=True)
+            if not len(columns):
                 logging.error("No products fetched. Exiting.")
+                profiler.stop()
+                metrics.export()
                 return
-            logging.info(f"Fetched {len(products)} products total.")
-            global_pbar.update(1)
 
-            # Step 2: Process base products without chunks
-            base_products = [p for p in products if p.get('variantsCount', -1) > 0]
-            results = []
-            async def limited_fetch_product_details_wrapper(prod):
-                async with semaphore:
-                    return await fetch_product_details(session, prod, base_product_paths)
-            tasks = [limited_fetch_product_details_wrapper(p) for p in base_products]
-            for coro in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc=color.YELLOW + "Fetching base product details" + color.END, leave=False):
-                try:
-                    details = await coro
-                    results.append(details)
-                except Exception as ex:
-                    logging.error(f"Error in fetch_product_details: {ex}")
-            global_pbar.update(1)
-
-            # Step 3: Process variant products without chunks
-            variants = [p for p in products if p.get('meta', {}).get('type') == 'variant']
-            tasks = [limited_fetch_product_details_wrapper(p) for p in variants]
-            for coro in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc=color.YELLOW + "Fetching variant details" + color.END, leave=False):
-                try:
-                    details = await coro
-                    results.append(details)
-                except Exception as ex:
-                    logging.error(f"Error in fetch_product_details: {ex}")
-            global_pbar.update(1)
+            # Variants take their parent's path, whatever order the pages came in
+            profiler.start("resolve_paths")
+            product_url = base_url.rsplit('/', 1)[0] + '/product'
+            await resolve_variant_paths(session, columns, index, product_url)
+            index.save()
+            logging.info(f"Fetched and processed {len(columns)} products total.")
+            logging.info(
+                f"Rate limit: {governor.throttled} throttled responses, "
+                f"{governor.waited_seconds:.1f}s waited, last remaining={governor.remaining}"
+            )
+            logging.info(
+                f"Resilience: {resilience.retries} retries for {resilience.requests} requests, "
+                f"{resilience.budget_denied} denied by budget, circuit opened {resilience.circuit_opened} times"
+            )
+            logging.info(f"Single-flight: {single_flight.saved} duplicate requests saved")
+            concurrency = governor.concurrency
+            logging.info(
+                f"Concurrency: limit {concurrency.limit} ({concurrency.min_limit}-{concurrency.max_limit}), "
+                f"mean {concurrency.mean_limit():.1f}, {concurrency.increases} increases, cuts {concurrency.decreases}"
+            )
+            global_pbar.update(3)
 
-            # Step 4: Convert raw results to DataFrame
-            out_data = []
-            for r in results:
-                if not r:
-                    continue
-                base_data = {
-                    'Путь': r['path'],
-                    'Наименование': r['name'],
-                    'Категория': r['category'],
-                    'Код товара': r['code'],
-                    'Порядковый номер': None,
-                    'Включено в план размещения': "-",
-                    'Фото на серевере': "-",
-                    'Дней на складе': r['days'],
-                    'Остаток': r['stock'],
-                    'ID': r['id'],
-                    'EAN13': r['ean13']  # New column for barcode data
-                }
-                for price_name, price_value in r['prices'].items():
-                    base_data[price_name] = price_value
-                out_data.append(base_data)
-            df_current = pd.DataFrame(out_data)
+            # Step 4: Build the DataFrame from the columns
+            profiler.start("dataframe")
+            df_current = columns.to_dataframe()
+            del columns
             global_pbar.update(1)
 
             # Step 5: Compare with previous CSV run to detect changes
+            profiler.start("diff")
             combined_data = compare_with_previous_run(df_current, previous_csv)
             global_pbar.update(1)
 
             # Step 6: Write new data into Excel file using "current" and "previous" sheets
+            profiler.start("excel_write")
             if os.path.exists(filename):
                 wb = openpyxl.load_workbook(filename)
                 if "previous" in wb.sheetnames:
@@ -494,16 +1676,20 @@ async def main():
             global_pbar.update(1)
 
             # Step 7: Save current subset for next run comparison
+            profiler.start("csv_snapshot")
             df_current[['Код товара', 'Остаток']].to_csv(previous_csv, index=False)
             global_pbar.update(1)
 
             # Step 8: Apply formatting and highlight changes on the new "current" sheet
+            profiler.start("formatting")
             add_dropdown_and_formatting(filename, sheet_name="current")
             wb = openpyxl.load_workbook(filename)
             ws = wb["current"]
             highlight_changes(ws, combined_data)
             wb.save(filename)
+            profiler.stop()
             global_pbar.update(1)
+            logging.info(f"Stages: {profiler.summary()}")
 
             # # Step 9: Update the SQLite database with current data
             # update_database(df_current, db_path)
@@ -512,6 +1698,7 @@ async def main():
             print(color.GREEN + f"Data saved into {filename}, sheet name: current" + color.END)
             logging.error(f"All steps completed successfully at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 
+    metrics.export()
 
     try:
         os.startfile(filename)
@@ -543,8 +1730,12 @@ async def main():
 # Script entry point
 # -------------------------------------------------------------------------------
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # Lets the frozen .exe start the process-pool workers
+    parser = argparse.ArgumentParser(description="Export the MoySklad assortment to Excel.")
+    Cassette.add_arguments(parser)
+    args = parser.parse_args()
     try:
-        asyncio.run(main())
+        asyncio.run(main(Cassette.from_args(args)))
     except Exception as ex:
         logging.error(f"Unhandled exception: {ex}")
         logging.error(traceback.format_exc())
@@ -0,0 +1,551 @@
+"""
+Local stand-in for the parts of the MoySklad Remap 1.2 API the scripts use,
+for load and throughput testing without touching a live account.
+
+Serves, under /api/remap/1.2/:
+
+    POST security/token
+    GET  entity/assortment              limit/offset, filter=id=..;productFolder=..;stockMode=positiveOnly
+    GET  entity/product[/{id}]          filter=id=..;id=..
+    GET  entity/variant[/{id}]          filter=productid=..
+    GET  entity/productfolder
+    GET  report/stock/all
+    GET  entity/{name}                  every other entity in tz1/aiwork.py ENDPOINTS
+
+from a synthetic catalog of any size (products with variants, folders,
+EAN-13 barcodes, the four price types, stock). Rows are generated from
+their index on request, so a million-item catalog costs a few MB.
+
+Latency, MoySklad's rate limit (requests per 3 s window plus 5 parallel
+requests, answered with 429 and the X-RateLimit-* / X-Lognex-* headers),
+random 5xx errors, always-failing offsets and an outage window that grows
+with every request it receives are all configurable.
+
+    python standin.py --items 100000 --latency 0.05 --rate-limit 45 --port 8080
+
+Benchmarks embed it with `async with StandIn(...) as server:` and point
+the scripts at `server.url('entity/assortment')`, or run it in a child
+process with `with StandInProcess('--items', '100000') as server:` so
+serving does not compete for the CPU with the code being measured.
+"""
+import argparse
+import asyncio
+import random
+import subprocess
+import sys
+import time
+from array import array
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiohttp import BasicAuth, web
+
+try:
+    import orjson  # optional: encodes pages several times faster
+except ImportError:
+    orjson = None
+
+API_PREFIX = '/api/remap/1.2'
+PRICE_TYPES = ["Цена розница", "Цена маркетплейс", "Цена мелкий опт", "Цена средний опт", "Цена закупочная"]
+DOCUMENT_ENTITIES = [
+    "customerorder", "demand", "salesreturn", "invoiceout", "paymentin", "purchaseorder", "supply",
+    "purchasereturn", "invoicein", "paymentout", "organization", "counterparty", "store", "project", "employee",
+]
+MAX_LIMIT = 1000
+
+
+def entity_uuid(kind: int, index: int) -> str:
+    # Stable, UUID-shaped ids that encode what they point at
+    return f"{kind:08x}-0000-4000-8000-{index:012x}"
+
+
+def parse_uuid(value: str) -> Optional[Tuple[int, int]]:
+    try:
+        kind, _, _, _, index = value.split('-')
+        return int(kind, 16), int(index, 16)
+    except ValueError:
+        return None
+
+
+def ean13(number: int) -> str:
+    digits = f"2{number:011d}"[-12:]
+    total = sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(digits))
+    return digits + str((10 - total % 10) % 10)
+
+
+KIND_ITEM, KIND_FOLDER, KIND_PRICETYPE, KIND_DOCUMENT = 1, 2, 3, 4
+
+
+class Catalog:
+    """
+    A synthetic account. Items are numbered 0..items-1 in assortment order:
+    each product is followed by its variants (or, with `shuffle`, in random
+    order so variants may come before their product).
+    """
+
+    def __init__(self, items: int = 10000, folders: int = 50, max_variants: int = 4,
+                 variant_share: float = 0.3, documents: int = 1000, seed: int = 0,
+                 shuffle: bool = False, host: str = 'http://127.0.0.1'):
+        self.items = items
+        self.folders = max(1, folders)
+        self.documents = documents
+        self.host = host
+        rng = random.Random(seed)
+        # parent[i] is -1 for a product, otherwise the item number of its product
+        self.parent = array('l')
+        self.variants = array('l')  # variantsCount per item (0 for variants)
+        i = 0
+        while i < items:
+            count = rng.randint(1, max_variants) if max_variants and rng.random() < variant_share else 0
+            count = min(count, items - i - 1)
+            self.parent.append(-1)
+            self.variants.append(count)
+            for _ in range(count):
+                self.parent.append(i)
+                self.variants.append(0)
+            i += count + 1
+        self.order = array('l', range(items))
+        if shuffle:
+            order = list(self.order)
+            rng.shuffle(order)
+            self.order = array('l', order)
+        self.products = array('l', (n for n in range(items) if self.parent[n] < 0))
+
+    def href(self, entity: str, entity_id: str) -> str:
+        return f"{self.host}{API_PREFIX}/entity/{entity}/{entity_id}"
+
+    def meta(self, entity: str, entity_id: str) -> Dict[str, Any]:
+        return {'href': self.href(entity, entity_id), 'type': entity, 'mediaType': 'application/json'}
+
+    def folder_path(self, folder: int) -> Tuple[str, str]:
+        # Two-level tree: "Группа 3/Подгруппа 17"
+        group = folder % 10
+        return (f"Группа {group}" if folder >= 10 else ""), (f"Подгруппа {folder}" if folder >= 10 else f"Группа {folder}")
+
+    def folder_row(self, folder: int) -> Dict[str, Any]:
+        parent_path, name = self.folder_path(folder)
+        row = {
+            'meta': self.meta('productfolder', entity_uuid(KIND_FOLDER, folder)),
+            'id': entity_uuid(KIND_FOLDER, folder),
+            'name': name,
+            'pathName': parent_path,
+            'archived': False,
+        }
+        if folder >= 10:
+            row['productFolder'] = {'meta': self.meta('productfolder', entity_uuid(KIND_FOLDER, folder % 10))}
+        return row
+
+    def stock(self, n: int) -> float:
+        return float(((n * 2654435761) & 0xffffffff) % 7)
+
+    def folder_of(self, n: int) -> int:
+        product = n if self.parent[n] < 0 else self.parent[n]
+        return product % self.folders
+
+    def item(self, n: int) -> Dict[str, Any]:
+        """The full assortment row of item `n`."""
+        parent = self.parent[n]
+        kind = 'product' if parent < 0 else 'variant'
+        item_id = entity_uuid(KIND_ITEM, n)
+        h = (n * 2654435761) & 0xffffffff
+        base_price = 1000 + h % 500000
+        row = {
+            'meta': self.meta(kind, item_id),
+            'id': item_id,
+            'name': f"Товар {n}" if parent < 0 else f"Товар {parent} ({n - parent})",
+            'code': f"{n:06d}",
+            'externalCode': f"ext{n}",
+            'archived': False,
+            'barcodes': [{'ean13': ean13(n)}],
+            'salePrices': [
+                {
+                    'value': float(base_price * (100 + 5 * i)),
+                    'currency': {'meta': self.meta('currency', entity_uuid(KIND_PRICETYPE, 0))},
+                    'priceType': {
+                        'meta': self.meta('pricetype', entity_uuid(KIND_PRICETYPE, i + 1)),
+                        'id': entity_uuid(KIND_PRICETYPE, i + 1),
+                        'name': name,
+                    },
+                }
+                for i, name in enumerate(PRICE_TYPES)
+            ],
+            'stock': self.stock(n),
+            'reserve': 0.0,
+            'inTransit': 0.0,
+            'quantity': self.stock(n),
+            'stockDays': h % 120,
+        }
+        if parent < 0:
+            parent_path, name = self.folder_path(self.folder_of(n))
+            row['pathName'] = f"{parent_path}/{name}" if parent_path else name
+            row['productFolder'] = {'meta': self.meta('productfolder', entity_uuid(KIND_FOLDER, self.folder_of(n)))}
+            row['variantsCount'] = self.variants[n]
+        else:
+            row['product'] = {'meta': self.meta('product', entity_uuid(KIND_ITEM, parent))}
+            row['characteristics'] = [
+                {'id': entity_uuid(KIND_PRICETYPE, 100), 'name': "Категория", 'value': "ABC"[(n - parent - 1) % 3]},
+                {'id': entity_uuid(KIND_PRICETYPE, 101), 'name': "Размер", 'value': str(40 + (n - parent))},
+            ]
+        return row
+
+    def stock_row(self, n: int) -> Dict[str, Any]:
+        """The report/stock/all row of item `n`."""
+        item = self.item(n)
+        folder = self.folder_of(n)
+        parent_path, name = self.folder_path(folder)
+        kind = item['meta']['type']
+        return {
+            'meta': {
+                'href': self.href(kind, item['id']) + '?expand=supplier',
+                'type': kind,
+                'mediaType': 'application/json',
+            },
+            'name': item['name'],
+            'code': item['code'],
+            'stock': item['stock'],
+            'reserve': 0.0,
+            'inTransit': 0.0,
+            'quantity': item['quantity'],
+            'stockDays': item['stockDays'],
+            'salePrice': item['salePrices'][0]['value'],
+            'folder': {
+                'href': self.href('productfolder', entity_uuid(KIND_FOLDER, folder)),
+                'name': name,
+                'pathName': parent_path,
+            },
+        }
+
+    def document_row(self, entity: str, n: int) -> Dict[str, Any]:
+        doc_id = entity_uuid(KIND_DOCUMENT, n)
+        return {
+            'meta': self.meta(entity, doc_id),
+            'id': doc_id,
+            'name': f"{n:05d}",
+            'moment': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(1_700_000_000 + n * 3600)),
+            'sum': float((n * 7919) % 1_000_000),
+            'applicable': True,
+        }
+
+
+class StandIn:
+    """
+    The stand-in server around a Catalog. Counters of what it served are in
+    `stats`; `reset_stats()` clears them between benchmark runs.
+    """
+
+    def __init__(self, catalog: Optional[Catalog] = None, latency: float = 0.0, jitter: float = 0.0,
+                 rate_limit: int = 0, window: float = 3.0, parallel_limit: int = 5,
+                 error_rate: float = 0.0, fail_offsets=(), outage_start: Optional[float] = None,
+                 outage: float = 0.0, penalty: float = 0.0, credentials: Optional[Tuple[str, str]] = None,
+                 seed: int = 0, host: str = '127.0.0.1', port: int = 0):
+        self.catalog = catalog or Catalog()
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.window = window
+        self.parallel_limit = parallel_limit
+        self.error_rate = error_rate
+        self.fail_offsets = set(fail_offsets)
+        self.outage_start = outage_start
+        self.outage = outage
+        self.penalty = penalty
+        self.credentials = credentials
+        self.host = host
+        self.port = port
+        self.token = "standin-token"
+        self._rng = random.Random(seed)
+        self._served: List[float] = []  # request times inside the current rate-limit window
+        self._in_flight = 0
+        self._runner: Optional[web.AppRunner] = None
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        self.started = time.monotonic()
+        self.outage_end = None if self.outage_start is None else self.outage_start + self.outage
+        self.stats: Dict[str, Any] = {
+            'requests': 0, 'throttled': 0, 'errors': 0, 'outage': 0, 'rows': 0, 'endpoints': {},
+        }
+
+    # ---------------------------------------------------------------------------
+    # Lifecycle
+    # ---------------------------------------------------------------------------
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[self._limits])
+        app['standin'] = self
+        app.router.add_post(f'{API_PREFIX}/security/token', self.security_token)
+        app.router.add_get(f'{API_PREFIX}/entity/assortment', self.assortment)
+        app.router.add_get(f'{API_PREFIX}/entity/product', self.product_list)
+        app.router.add_get(f'{API_PREFIX}/entity/variant', self.variant_list)
+        app.router.add_get(f'{API_PREFIX}/entity/productfolder', self.folder_list)
+        app.router.add_get(f'{API_PREFIX}/entity/{{entity:product|variant}}/{{id}}', self.single_item)
+        app.router.add_get(f'{API_PREFIX}/report/stock/all', self.stock_report)
+        app.router.add_get(f'{API_PREFIX}/entity/{{entity}}', self.document_list)
+        return app
+
+    async def start(self) -> 'StandIn':
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.catalog.host = f"http://{self.host}:{self.port}"
+        self.reset_stats()
+        return self
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self) -> 'StandIn':
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.stop()
+
+    def url(self, path: str = '') -> str:
+        return f"http://{self.host}:{self.port}{API_PREFIX}/{path.lstrip('/')}"
+
+    # ---------------------------------------------------------------------------
+    # Latency, rate limits and injected failures, applied to every request
+    # ---------------------------------------------------------------------------
+    def _rate_limit_headers(self) -> Tuple[bool, Dict[str, str]]:
+        now = time.monotonic()
+        while self._served and self._served[0] <= now - self.window:
+            self._served.pop(0)
+        interval = str(int(self.window * 1000))
+        if len(self._served) >= self.rate_limit:
+            reset_ms = str(int((self._served[0] + self.window - now) * 1000))
+            return False, {
+                'X-RateLimit-Limit': str(self.rate_limit),
+                'X-RateLimit-Remaining': '0',
+                'X-Lognex-Retry-TimeInterval': interval,
+                'X-Lognex-Retry-After': reset_ms,
+                'X-Lognex-Reset': reset_ms,
+            }
+        self._served.append(now)
+        return True, {
+            'X-RateLimit-Limit': str(self.rate_limit),
+            'X-RateLimit-Remaining': str(self.rate_limit - len(self._served)),
+            'X-Lognex-Retry-TimeInterval': interval,
+            'X-Lognex-Reset': str(int((self._served[0] + self.window - now) * 1000)),
+        }
+
+    @staticmethod
+    def _error(status: int, message: str, code: int = 0, headers=None) -> web.Response:
+        return web.json_response({'errors': [{'error': message, 'code': code}]}, status=status, headers=headers)
+
+    @web.middleware
+    async def _limits(self, request: web.Request, handler):
+        stats = self.stats
+        stats['requests'] += 1
+        resource = getattr(request.match_info.route, 'resource', None)
+        endpoint = resource.canonical if resource is not None else request.path
+        stats['endpoints'][endpoint] = stats['endpoints'].get(endpoint, 0) + 1
+
+        if self.outage_end is not None:
+            elapsed = time.monotonic() - self.started
+            if self.outage_start <= elapsed < self.outage_end:
+                # Like an overloaded backend: every request received pushes recovery back
+                stats['outage'] += 1
+                self.outage_end += self.penalty
+                return self._error(503, "injected outage")
+
+        headers = {}
+        if self.rate_limit:
+            allowed, headers = self._rate_limit_headers()
+            if not allowed:
+                stats['throttled'] += 1
+                return self._error(429, "Превышено ограничение на количество запросов", 1049, headers)
+        if self.parallel_limit and self._in_flight >= self.parallel_limit:
+            stats['throttled'] += 1
+            headers['X-Lognex-Retry-After'] = '100'
+            return self._error(429, "Превышено ограничение на количество параллельных запросов", 1049, headers)
+
+        self._in_flight += 1
+        try:
+            delay = self.latency + (self._rng.uniform(0, self.jitter) if self.jitter else 0)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self.error_rate and self._rng.random() < self.error_rate:
+                stats['errors'] += 1
+                return self._error(self._rng.choice((500, 502, 503)), "injected error")
+            if request.query.get('offset', '0').isdigit() and int(request.query.get('offset', 0)) in self.fail_offsets:
+                stats['errors'] += 1
+                return self._error(500, "injected error")
+            response = await handler(request)
+        finally:
+            self._in_flight -= 1
+        response.headers.update(headers)
+        return response
+
+    # ---------------------------------------------------------------------------
+    # Handlers
+    # ---------------------------------------------------------------------------
+    def _page(self, request: web.Request, entity: str, numbers, size: int, make_row) -> web.Response:
+        limit = min(int(request.query.get('limit', MAX_LIMIT)), MAX_LIMIT)
+        offset = int(request.query.get('offset', 0))
+        rows = [make_row(n) for n in numbers[offset:offset + limit]]
+        self.stats['rows'] += len(rows)
+        meta = {
+            'href': str(request.url),
+            'type': entity,
+            'mediaType': 'application/json',
+            'size': size,
+            'limit': limit,
+            'offset': offset,
+        }
+        if offset + limit < size:
+            meta['nextHref'] = str(request.url.update_query(limit=limit, offset=offset + limit))
+        page = {'context': {}, 'meta': meta, 'rows': rows}
+        if orjson is not None:
+            return web.Response(body=orjson.dumps(page), content_type='application/json')
+        return web.json_response(page)
+
+    @staticmethod
+    def _filters(request: web.Request) -> Dict[str, List[str]]:
+        filters: Dict[str, List[str]] = {}
+        for clause in request.query.get('filter', '').split(';'):
+            key, sep, value = clause.partition('=')
+            if sep:
+                filters.setdefault(key, []).append(value)
+        return filters
+
+    def _item_numbers(self, ids: List[str]) -> List[int]:
+        numbers = []
+        for value in ids:
+            parsed = parse_uuid(value.rsplit('/', 1)[-1])
+            if parsed and parsed[0] == KIND_ITEM and parsed[1] < self.catalog.items:
+                numbers.append(parsed[1])
+        return numbers
+
+    async def security_token(self, request: web.Request) -> web.Response:
+        if self.credentials is not None:
+            try:
+                auth = BasicAuth.decode(request.headers.get('Authorization', ''))
+            except ValueError:
+                auth = None
+            if auth is None or (auth.login, auth.password) != self.credentials:
+                return self._error(401, "Ошибка аутентификации", 1056)
+        return web.json_response({'access_token': self.token}, status=201)
+
+    async def assortment(self, request: web.Request) -> web.Response:
+        catalog = self.catalog
+        filters = self._filters(request)
+        if 'id' in filters:
+            numbers = self._item_numbers(filters['id'])
+        else:
+            numbers = catalog.order
+        if 'productFolder' in filters:
+            folders = {parse_uuid(href.rsplit('/', 1)[-1]) for href in filters['productFolder']}
+            numbers = [n for n in numbers if (KIND_FOLDER, catalog.folder_of(n)) in folders]
+        if filters.get('stockMode') == ['positiveOnly']:
+            numbers = [n for n in numbers if catalog.stock(n) > 0]
+        return self._page(request, 'assortment', numbers, len(numbers), catalog.item)
+
+    async def product_list(self, request: web.Request) -> web.Response:
+        catalog = self.catalog
+        filters = self._filters(request)
+        if 'id' in filters:
+            products = [n for n in self._item_numbers(filters['id']) if catalog.parent[n] < 0]
+        else:
+            products = catalog.products
+        return self._page(request, 'product', products, len(products), catalog.item)
+
+    async def variant_list(self, request: web.Request) -> web.Response:
+        catalog = self.catalog
+        filters = self._filters(request)
+        if 'productid' in filters:
+            parents = set(self._item_numbers(filters['productid']))
+            numbers = [n for p in sorted(parents) for n in range(p + 1, p + 1 + catalog.variants[p])]
+        else:
+            numbers = [n for n in range(catalog.items) if catalog.parent[n] >= 0]
+        return self._page(request, 'variant', numbers, len(numbers), catalog.item)
+
+    async def single_item(self, request: web.Request) -> web.Response:
+        numbers = self._item_numbers([request.match_info['id']])
+        if not numbers:
+            return self._error(404, "Объект не найден", 1021)
+        row = self.catalog.item(numbers[0])
+        if row['meta']['type'] != request.match_info['entity']:
+            return self._error(404, "Объект не найден", 1021)
+        return web.json_response(row)
+
+    async def folder_list(self, request: web.Request) -> web.Response:
+        folders = range(self.catalog.folders)
+        return self._page(request, 'productfolder', folders, len(folders), self.catalog.folder_row)
+
+    async def stock_report(self, request: web.Request) -> web.Response:
+        catalog = self.catalog
+        return self._page(request, 'stock', catalog.order, catalog.items, catalog.stock_row)
+
+    async def document_list(self, request: web.Request) -> web.Response:
+        entity = request.match_info['entity']
+        if entity not in DOCUMENT_ENTITIES:
+            return self._error(404, f"Неизвестный тип: {entity}", 1002)
+        documents = range(self.catalog.documents)
+        return self._page(request, entity, documents, len(documents),
+                          lambda n: self.catalog.document_row(entity, n))
+
+
+class StandInProcess:
+    """Runs `python standin.py <args>` in a child process for as long as the block lasts."""
+
+    def __init__(self, *args: str):
+        self.args = [str(arg) for arg in args]
+        self.process: Optional[subprocess.Popen] = None
+        self.base_url = ''
+
+    def __enter__(self) -> 'StandInProcess':
+        self.process = subprocess.Popen(
+            [sys.executable, __file__, '--port', '0', *self.args],
+            stdout=subprocess.PIPE, text=True, encoding='utf-8',
+        )
+        line = self.process.stdout.readline()
+        if ' at ' not in line:
+            self.process.kill()
+            raise RuntimeError(f"stand-in did not start: {line!r}")
+        self.base_url = line.rsplit(' at ', 1)[1].strip().rstrip('/')
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.process.terminate()
+        self.process.wait()
+
+    def url(self, path: str = '') -> str:
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+
+async def serve(args: argparse.Namespace) -> None:
+    catalog = Catalog(items=args.items, folders=args.folders, max_variants=args.max_variants,
+                      documents=args.documents, seed=args.seed, shuffle=args.shuffle)
+    server = StandIn(catalog, latency=args.latency, jitter=args.jitter, rate_limit=args.rate_limit,
+                     parallel_limit=args.parallel_limit, error_rate=args.error_rate,
+                     fail_offsets=args.fail_offset, port=args.port)
+    async with server:
+        print(f"MoySklad stand-in with {catalog.items} items at {server.url()}", flush=True)
+        while True:
+            await asyncio.sleep(3600)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=10000, help='assortment size (products + variants)')
+    parser.add_argument('--folders', type=int, default=50)
+    parser.add_argument('--max-variants', type=int, default=4, help='variants per product with variants')
+    parser.add_argument('--documents', type=int, default=1000, help='rows per document endpoint')
+    parser.add_argument('--shuffle', action='store_true', help='serve the assortment in random order')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='extra random latency, up to this many seconds')
+    parser.add_argument('--rate-limit', type=int, default=0,
+                        help='requests allowed per 3s window, as MoySklad enforces (0 = unlimited)')
+    parser.add_argument('--parallel-limit', type=int, default=5,
+                        help='parallel requests allowed, 5 like MoySklad (0 = unlimited)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with a 5xx')
+    parser.add_argument('--fail-offset', type=int, action='append', default=[],
+                        help='answer this offset with HTTP 500 (repeatable)')
+    parser.add_argument('--port', type=int, default=8080)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -1,13 +1,26 @@
+import argparse
 import asyncio
 import aiohttp
 import pandas as pd
 import json
+import logging
 import os
 import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog, Menu
 from aiohttp import ClientSession
-from requests.auth import HTTPBasicAuth
 from datetime import datetime
+from urllib.parse import urlencode
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # moysklad_common/
+from moysklad_common.auth import TokenAuth
+from moysklad_common.cache import ResponseCache
+from moysklad_common.cassette import Cassette
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+    handlers=[logging.FileHandler('app.log', mode='w')]
+)
 
 # Base API URL
 BASE_URL = "https://api.moysklad.ru/api/remap/1.2/entity"
@@ -37,6 +50,18 @@ ENDPOINTS = {
 
 EMAILS_FILE = "used_emails.json"
 
+CACHE_FILE = "http_cache.db"
+CACHE_MAX_BYTES = 50 * 1024 * 1024
+# Seconds a cached response is served without revalidation, per entity
+CACHE_TTLS = {
+    "productfolder": 3600,
+    "store": 86400,
+    "organization": 86400,
+    "project": 86400,
+    "pricetype": 86400,
+    "metadata": 86400,
+}
+
 # Authentication Manager
 class AuthManager:
     @staticmethod
@@ -72,21 +97,107 @@ class AuthManager:
 
 # API Client
 class MoySkladAPI:
-    def __init__(self, auth):
+    """
+    Long-lived async client: one connection pool (keep-alive, per-host limit,
+    cached DNS) shared by every endpoint in ENDPOINTS.
+
+    Use it as `async with MoySkladAPI(auth) as api:` or call open()/close()
+    explicitly; the pool is opened lazily on the first request otherwise.
+    Responses of slowly changing entities go through `cache` when one is given,
+    and all traffic is recorded to or replayed from `cassette` when one is given.
+    """
+
+    def __init__(self, auth, base_url=BASE_URL, limit=20, limit_per_host=5,
+                 keepalive_timeout=60, dns_ttl=300, timeout=10, ssl=True, cache=None,
+                 cassette=None):
         self.auth = auth
+        self.cache = cache
+        self.cassette = cassette
+        self.endpoints = ENDPOINTS if base_url == BASE_URL else {
+            name: f"{base_url}/{name}" for name in ENDPOINTS
+        }
+        self.limit = limit
+        self.limit_per_host = limit_per_host  # MoySklad allows 5 parallel requests per user
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_ttl = dns_ttl
+        self.timeout = timeout
+        self.ssl = ssl
+        self.session = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self):
+        if self.session is not None and not self.session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            use_dns_cache=True,
+            ttl_dns_cache=self.dns_ttl,
+            ssl=self.ssl,
+        )
+        self.session = ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers={"Accept-Encoding": "gzip"},
+        )
+        if self.cassette is not None:
+            self.session = self.cassette.wrap(self.session)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
 
     async def fetch_data(self, endpoint, params=None):
-        url = ENDPOINTS[endpoint]
-        async with ClientSession() as session:
-            for _ in range(3):  # Retry up to 3 times
-                try:
-                    async with session.get(url, params=params, auth=self.auth, timeout=10) as response:
-                        if response.status == 200:
-                            return await response.json()
-                        elif response.status == 429:
-                            await asyncio.sleep(1)  # Rate limit handling
-                except aiohttp.ClientError:
-                    await asyncio.sleep(1)
+        url = self.endpoints[endpoint]
+        account = self.auth.login if self.auth else ""
+        cache_key = f"{url}?{urlencode(params)}" if params else url
+        cacheable = self.cache is not None and self.cache.ttl_for(url) is not None
+        cached = self.cache.lookup(account, cache_key) if cacheable else None
+        if cached is not None and self.cache.is_fresh(cached, url):
+            self.cache.hits += 1
+            return json.loads(cached.body)
+
+        await self.open()
+        token_refreshed = False
+        for _ in range(3):  # Retry up to 3 times
+            try:
+                headers = await self.auth.headers(self.session) if self.auth else {}
+                token = self.auth.token if self.auth else None
+                if cached:
+                    headers.update(ResponseCache.conditional_headers(cached))
+                async with self.session.get(url, params=params, headers=headers) as response:
+                    if response.status == 401 and self.auth and not token_refreshed:
+                        token_refreshed = True
+                        await response.read()
+                        if await self.auth.refresh(self.session, token):
+                            continue
+                        return None
+                    if response.status == 304 and cached is not None:
+                        self.cache.revalidated += 1
+                        self.cache.refresh(account, cache_key)
+                        return json.loads(cached.body)
+                    if response.status == 200 and cacheable:
+                        body = await response.read()
+                        self.cache.misses += 1
+                        self.cache.store(account, cache_key, response.headers, body)
+                        return json.loads(body)
+                    if response.status == 200:
+                        return await response.json()
+                    elif response.status == 429:
+                        await asyncio.sleep(1)  # Rate limit handling
+                    else:
+                        # Drain the body so the connection goes back to the pool
+                        await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                await asyncio.sleep(1)
         return None
 
     async def fetch_entities(self, entity_type, filters=None):
@@ -104,13 +215,21 @@ class DataExporter:
 
 # GUI Application
 class MoySkladApp:
-    def __init__(self, root):
+    def __init__(self, root, cassette=None):
         self.root = root
         self.auth = None
         self.api = None
         self.folder_metadata = {}
+        self.cassette = cassette
+        self.replaying = cassette is not None and cassette.replay
+        # One event loop for the whole app so the API client's connection
+        # pool survives between button clicks.
+        self.loop = asyncio.new_event_loop()
+        # A replayed run answers from the cassette alone
+        self.cache = None if self.replaying else ResponseCache(CACHE_FILE, CACHE_TTLS, CACHE_MAX_BYTES)
 
         self.setup_gui()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
     def setup_gui(self):
         self.root.title("MoySklad API Fetcher")
@@ -135,10 +254,22 @@ class MoySkladApp:
         login_button.pack(pady=10)
 
     def authenticate(self):
-        self.auth = HTTPBasicAuth(self.email_entry.get(), self.password_entry.get())
-        self.api = MoySkladAPI(self.auth)
+        if not self.replaying:
+            self.auth = TokenAuth(self.email_entry.get(), self.password_entry.get())
+        if self.api is not None:
+            self.loop.run_until_complete(self.api.close())
+        self.api = MoySkladAPI(self.auth, cache=self.cache, cassette=self.cassette)
         self.open_main_menu()
 
+    def on_close(self):
+        if self.api is not None:
+            self.loop.run_until_complete(self.api.close())
+        self.loop.close()
+        if self.cache is not None:
+            logging.info(self.cache.summary())
+            self.cache.close()
+        self.root.destroy()
+
     def open_main_menu(self):
         for widget in self.root.winfo_children():
             widget.destroy()
@@ -155,16 +286,21 @@ class MoySkladApp:
         if not entity_type:
             messagebox.showerror("Error", "Please select an entity type.")
             return
-        asyncio.run(self.process_data(entity_type))
+        self.loop.run_until_complete(self.process_data(entity_type))
 
     async def process_data(self, entity_type):
         data = await self.api.fetch_entities(entity_type)
+        if self.cache is not None:
+            logging.info(self.cache.summary())
         if data:
             DataExporter.export_to_excel(data, entity_type)
         else:
             messagebox.showinfo("Info", "No data found.")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MoySklad API Fetcher")
+    Cassette.add_arguments(parser)
+    args = parser.parse_args()
     root = tk.Tk()
-    app = MoySkladApp(root)
+    app = MoySkladApp(root, cassette=Cassette.from_args(args))
     root.mainloop()
@@ -0,0 +1,102 @@
+"""
+Microbenchmark: ClientSession per call vs the pooled MoySkladAPI client.
+
+Serves a small entity page over HTTPS from a local aiohttp server with a
+throwaway self-signed certificate (generated with the openssl CLI) and
+times N sequential fetch_entities() calls both ways. The server counts
+distinct connections, i.e. TCP+TLS handshakes.
+
+    python bench_client_pool.py --calls 200
+"""
+import argparse
+import asyncio
+import os
+import ssl
+import subprocess
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import ClientSession, web
+
+from aiwork import ENDPOINTS, MoySkladAPI, TokenAuth
+
+
+def make_server_ssl_context(directory):
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+         '-subj', '/CN=127.0.0.1', '-keyout', key, '-out', cert],
+        check=True, capture_output=True,
+    )
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+def make_app():
+    connections = set()
+
+    async def entity(request):
+        connections.add(request.transport.get_extra_info('peername'))
+        name = request.match_info['name']
+        return web.json_response({
+            'meta': {'size': 1, 'limit': 1000, 'offset': 0},
+            'rows': [{'id': '1', 'name': f'{name} 1'}],
+        })
+
+    async def token(request):
+        return web.json_response({'access_token': 'bench'}, status=201)
+
+    app = web.Application()
+    app['connections'] = connections
+    app.router.add_get('/entity/{name}', entity)
+    app.router.add_post('/security/token', token)
+    return app
+
+
+class SessionPerCallAPI(MoySkladAPI):
+    """The previous behaviour: a fresh ClientSession (and handshake) for every call."""
+
+    async def fetch_data(self, endpoint, params=None):
+        async with ClientSession(connector=aiohttp.TCPConnector(ssl=self.ssl)) as session:
+            headers = await self.auth.headers(session)
+            async with session.get(self.endpoints[endpoint], params=params, headers=headers) as response:
+                return await response.json()
+
+
+async def run(calls):
+    app = make_app()
+    with tempfile.TemporaryDirectory() as directory:
+        server_ssl = make_server_ssl_context(directory)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0, ssl_context=server_ssl)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        base_url = f'https://127.0.0.1:{port}/entity'
+        auth = TokenAuth('bench', 'bench', token_url=f'https://127.0.0.1:{port}/security/token',
+                         token_file=os.path.join(directory, 'tokens.json'))
+        endpoints = list(ENDPOINTS)
+
+        try:
+            for label, api_class in (('session per call', SessionPerCallAPI), ('pooled client', MoySkladAPI)):
+                app['connections'].clear()
+                # Certificate verification is off for the self-signed cert; the handshake still happens
+                async with api_class(auth, base_url=base_url, ssl=False) as api:
+                    start = time.perf_counter()
+                    for i in range(calls):
+                        await api.fetch_entities(endpoints[i % len(endpoints)])
+                    elapsed = time.perf_counter() - start
+                print(f"{label:>16}: {calls} calls in {elapsed:.2f}s "
+                      f"({elapsed / calls * 1000:.2f} ms/call, {len(app['connections'])} handshakes)")
+        finally:
+            await runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--calls', type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(run(args.calls))
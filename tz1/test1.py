@@ -4,8 +4,10 @@ import json
 import os
 import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog, Menu
-from requests.auth import HTTPBasicAuth
 from datetime import datetime
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # moysklad_common/
+from moysklad_common.auth import BearerTokenAuth
 
 # MoySklad API credentials
 API_URL = "https://api.moysklad.ru/api/remap/1.2/entity/product"
@@ -51,21 +53,44 @@ def fetch_products(folder_hrefs, auth):
         products.extend([p for p in response.json().get('rows', []) if p.get('stock', 0) > 0])  # Filter only in-stock products
     return products
 
-def fetch_variants(product_id, auth):
-    response = requests.get(f"{VARIANTS_URL}?filter=product={product_id}", auth=auth)
-    if response.status_code != 200:
-        return "No Category"
-    variants = response.json().get('rows', [])
-    characteristics = []
-    for v in variants:
-        char_values = [char.get("value", "") for char in v.get("characteristics", []) if char.get("value")]
-        characteristics.extend(char_values)
-    return ", ".join(characteristics) if characteristics else "No Category"
+VARIANT_FILTER_CHUNK = 100  # product ids per variant request; keeps the URL a few KB long
+
+# Fetch variants of all given products in paginated bulk requests and map
+# product id -> "value, value" built from their characteristics; None if a
+# request failed, since a partial map would leave products without their values
+def fetch_variants_map(product_ids, auth):
+    ids = list(dict.fromkeys(pid for pid in product_ids if pid))
+    characteristics = {}
+    with requests.Session() as session:
+        session.auth = auth
+        for start in range(0, len(ids), VARIANT_FILTER_CHUNK):
+            id_filter = ";".join(f"productid={pid}" for pid in ids[start:start + VARIANT_FILTER_CHUNK])
+            offset = 0
+            while True:
+                params = {'filter': id_filter, 'limit': 1000, 'offset': offset}
+                response = session.get(VARIANTS_URL, params=params)
+                if response.status_code != 200:
+                    messagebox.showerror("Error", f"Error fetching variants (HTTP {response.status_code}), export cancelled.")
+                    return None
+                variants = response.json().get('rows', [])
+                for v in variants:
+                    parent_id = v.get('product', {}).get('meta', {}).get('href', '').split('/')[-1]
+                    values = characteristics.setdefault(parent_id, [])
+                    values.extend(char.get("value", "") for char in v.get("characteristics", []) if char.get("value"))
+                if len(variants) < 1000:
+                    break
+                offset += 1000
+    return {pid: ", ".join(values) for pid, values in characteristics.items() if values}
 
 def export_to_excel(products, folder_name):
     timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     filename = f"{folder_name}_{timestamp}.xlsx"
     
+    # Resolve variant characteristics for all products at once
+    variant_map = fetch_variants_map([p.get('id') for p in products], auth)
+    if variant_map is None:
+        return
+
     # Organize products by category
     category_data = {}
     for p in products:
@@ -74,7 +99,7 @@ def export_to_excel(products, folder_name):
         product_code = p.get('code', 'No Code')
         product_price = p.get('salePrices', [{}])[0].get('value', 0) / 100
         product_stock = p.get('stock', 0)
-        product_categories = fetch_variants(p.get('id', ''), auth) if p.get('id') else "No Category"
+        product_categories = variant_map.get(p.get('id'), "No Category")
         
         if category not in category_data:
             category_data[category] = []
@@ -129,7 +154,7 @@ def create_gui():
     
     def authenticate():
         global auth
-        auth = HTTPBasicAuth(email_entry.get(), password_entry.get())
+        auth = BearerTokenAuth(email_entry.get(), password_entry.get())
         open_main_menu(root, auth)
     
     login_button = tk.Button(root, text="Login", command=authenticate)
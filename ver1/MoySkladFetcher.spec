@@ -1,9 +1,10 @@
 # -*- mode: python ; coding: utf-8 -*-
+import os
 
 
 a = Analysis(
     ['moyskladapiv1.py'],
-    pathex=[],
+    pathex=[os.path.dirname(SPECPATH)],  # moysklad_common/
     binaries=[],
     datas=[],
     hiddenimports=[],
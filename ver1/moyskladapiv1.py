@@ -1,11 +1,25 @@
 import requests
 import pandas as pd
 import json
+import logging
 import os
+import threading
+import time
 import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog, Menu
-from requests.auth import HTTPBasicAuth
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlencode
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # moysklad_common/
+from moysklad_common.auth import BearerTokenAuth
+from moysklad_common.cache import ResponseCache
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+    handlers=[logging.FileHandler('app.log', mode='w')]
+)
 
 EMAILS_FILE = "used_emails.json"
 
@@ -13,7 +27,61 @@ API_BASE_URL = 'https://api.moysklad.ru/api/remap/1.2/entity'
 FOLDERS_URL = f'{API_BASE_URL}/productfolder'
 ASSORTMENT_URL = f'{API_BASE_URL}/assortment'
 
+MAX_WORKERS = 5  # MoySklad allows 5 parallel requests per user
+PAGE_SIZE = 1000
+
+CACHE_FILE = "http_cache.db"
+CACHE_MAX_BYTES = 50 * 1024 * 1024
+# Seconds a cached response is served without revalidation, per entity
+CACHE_TTLS = {
+    "productfolder": 3600,
+    "store": 86400,
+    "organization": 86400,
+    "pricetype": 86400,
+    "metadata": 86400,
+}
+
+class ThrottlePause:
+    """
+    Backoff shared by the worker threads. A 429 seen by one thread holds back
+    every thread until the interval the API asked for has passed; after that
+    requests go out one at a time, at the rate the rate-limit window allows,
+    until the remaining budget recovers. Otherwise each thread sleeps on its
+    own 429 and they all hit the limit again together.
+    """
+
+    def __init__(self, low_watermark=2 * MAX_WORKERS):
+        self.low_watermark = low_watermark
+        self._lock = threading.Lock()
+        self._next = 0.0     # monotonic time before which no request may be sent
+        self._spacing = 0.0  # gap between requests while recovering from a 429
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            send_at = max(now, self._next)
+            self._next = send_at + self._spacing
+        if send_at > now:
+            time.sleep(send_at - now)
+
+    def update(self, response):
+        # The X-Lognex-* intervals are in milliseconds
+        headers = response.headers
+        with self._lock:
+            if response.status_code == 429:
+                delay = float(headers.get('X-Lognex-Retry-After', 1000)) / 1000
+                self._next = max(self._next, time.monotonic() + delay)
+                interval = float(headers.get('X-Lognex-Retry-TimeInterval', 0)) / 1000
+                limit = float(headers.get('X-RateLimit-Limit', 0))
+                self._spacing = interval / limit if interval and limit else 0.1
+            elif int(headers.get('X-RateLimit-Remaining', self.low_watermark + 1)) > self.low_watermark:
+                self._spacing = 0.0
+
 auth = None
+cache = None
+throttle = ThrottlePause()
+http = requests.Session()
+http.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=MAX_WORKERS))
 
 def load_used_emails():
     try:
@@ -48,8 +116,25 @@ def fill_email(event):
         email_entry.set(email)
 
 def fetch_data(url, params=None):
-    response = requests.get(url, auth=auth, params=params)
+    # Slowly changing entities (folders, stores, ...) go through the disk cache
+    account = auth.login if auth else ""
+    cache_key = f"{url}?{urlencode(params)}" if params else url
+    cacheable = cache is not None and cache.ttl_for(url) is not None
+    cached = cache.lookup(account, cache_key) if cacheable else None
+    if cached is not None and cache.is_fresh(cached, url):
+        cache.hits += 1
+        return json.loads(cached.body).get('rows', [])
+
+    headers = ResponseCache.conditional_headers(cached) if cached else None
+    response = http.get(url, auth=auth, params=params, headers=headers)
+    if response.status_code == 304 and cached is not None:
+        cache.revalidated += 1
+        cache.refresh(account, cache_key)
+        return json.loads(cached.body).get('rows', [])
     if response.status_code == 200:
+        if cacheable:
+            cache.misses += 1
+            cache.store(account, cache_key, response.headers, response.content)
         return response.json().get('rows', [])
     messagebox.showerror("Error", f"Failed to fetch data from {url}")
     return []
@@ -61,23 +146,53 @@ def get_all_subfolders(folders, parent_folder_id):
     subfolders = get_subfolders(folders, parent_folder_id)
     return subfolders + [sf for folder in subfolders for sf in get_all_subfolders(folders, folder['meta']['href'])]
 
+def fetch_folder_page(folder_href, offset, retries=5):
+    params = {'filter': f'productFolder={folder_href}', 'limit': PAGE_SIZE, 'offset': offset}
+    for _ in range(retries):
+        throttle.wait()
+        response = http.get(ASSORTMENT_URL, auth=auth, params=params)
+        throttle.update(response)
+        if response.status_code == 429:
+            continue
+        if response.status_code != 200:
+            return None
+        return response.json()
+    return None
+
 def fetch_products(folder_hrefs):
-    products = []
-    for folder_href in folder_hrefs:
-        offset = 0
-        while True:
-            params = {'filter': f'productFolder={folder_href}', 'limit': 1000, 'offset': offset}
-            batch = fetch_data(ASSORTMENT_URL, params)
-            products.extend(batch)
-            if len(batch) < 1000:
-                break
-            offset += 1000
-    return products
+    # Fetch the first page of every folder at once, then the remaining pages as
+    # soon as meta.size is known, all on one shared pool of MAX_WORKERS requests.
+    # Products are yielded as pages arrive; ones found under several folders only once.
+    seen = set()
+    failed_pages = 0
+    unique_hrefs = list(dict.fromkeys(folder_hrefs))
+    if len(unique_hrefs) < len(folder_hrefs):
+        logging.info(f"Skipped {len(folder_hrefs) - len(unique_hrefs)} duplicate folder fetches")
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        pending = {pool.submit(fetch_folder_page, href, 0): (href, 0) for href in unique_hrefs}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                folder_href, offset = pending.pop(future)
+                data = future.result()
+                if data is None:
+                    failed_pages += 1
+                    continue
+                if offset == 0:
+                    size = data.get('meta', {}).get('size', 0)
+                    for page_offset in range(PAGE_SIZE, size, PAGE_SIZE):
+                        pending[pool.submit(fetch_folder_page, folder_href, page_offset)] = (folder_href, page_offset)
+                for product in data.get('rows', []):
+                    if product['id'] not in seen:
+                        seen.add(product['id'])
+                        yield product
+    if failed_pages:
+        messagebox.showerror("Error", f"Failed to fetch {failed_pages} page(s) of products.")
 
 def export_to_excel(products, folder_name):
     timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     filename = f"{folder_name}_{timestamp}.xlsx"
-    df = pd.DataFrame([
+    rows = [
         {
             'Code': p.get('code', ''),
             'Name': p.get('name', ''),
@@ -86,9 +201,12 @@ def export_to_excel(products, folder_name):
             )
         }
         for p in products
-    ])
-    df.to_excel(filename, index=False)
+    ]
+    if not rows:
+        return 0
+    pd.DataFrame(rows).to_excel(filename, index=False)
     messagebox.showinfo("Success", f"Data exported to {filename}")
+    return len(rows)
 
 def open_main_menu(root, email, name):
     for widget in root.winfo_children():
@@ -99,6 +217,7 @@ def open_main_menu(root, email, name):
     tree.pack(expand=True, fill=tk.BOTH)
 
     all_folders = fetch_data(FOLDERS_URL)
+    logging.info(cache.summary())
     folder_dict = {}
 
     def populate_tree(parent, folders):
@@ -119,15 +238,14 @@ def open_main_menu(root, email, name):
             selected_folders = [selected_folder] + [sf['meta']['href'] for sf in get_all_subfolders(all_folders, selected_folder)]
         else:
             selected_folders = [selected_folder]
-        products = fetch_products(selected_folders)
-        if products:
-            export_to_excel(products, folder_name)
-        else:
+        if not export_to_excel(fetch_products(selected_folders), folder_name):
             messagebox.showinfo("Info", "No products found.")
 
     tk.Button(root, text="Fetch Products", command=on_fetch).pack(pady=10)
 
 def create_gui():
+    global cache
+    cache = ResponseCache(CACHE_FILE, CACHE_TTLS, CACHE_MAX_BYTES)
     root = tk.Tk()
     root.title("MoySklad Product Fetcher")
     root.geometry("600x400")
@@ -152,7 +270,7 @@ def create_gui():
         password = password_entry.get()
         name = next((n for e, n in load_used_emails().items() if e == email), None) or simpledialog.askstring("User Name", "Enter a name for this email:")
         save_used_email(email, name)
-        auth = HTTPBasicAuth(email, password)
+        auth = BearerTokenAuth(email, password)
         open_main_menu(root, email, name)
 
     tk.Button(root, text="Login", command=authenticate).pack(pady=10)